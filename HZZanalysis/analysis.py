@@ -0,0 +1,149 @@
+"""The per-chunk H -> ZZ -> 4l analysis: selection, invariant mass and Monte Carlo weights
+
+Shared by the consumers of the broker pipeline and the dask executor, so both run the same code.
+"""
+import os
+import infofile
+import numpy as np
+import awkward as ak
+import vector
+import histograms
+import selection
+
+MeV = 0.001
+GeV = 1.0
+
+# Kinematics and weights are computed in float32 and integer branches in int32, as they are stored in
+# the ROOT files, and only the sums (histograms and cutflows) are kept in float64. Events decoded from
+# JSON come as float64 and int64 and are cast as soon as they are decoded, which halves the memory
+# they take. COMPUTE_DTYPE=float64 computes the kinematics in double precision instead.
+compute_dtype = np.dtype(os.getenv('COMPUTE_DTYPE', 'float32'))
+
+variables = ['lep_pt','lep_eta','lep_phi','lep_E','lep_charge','lep_type']
+# Per-event columns process_sample adds before the cuts, which cuts can read as well as the lepton branches
+derived = ['leading_lep_pt', 'sub_leading_lep_pt', 'third_leading_lep_pt', 'last_lep_pt']
+weight_variables = ["mcWeight", "scaleFactor_PILEUP", "scaleFactor_ELE", "scaleFactor_MUON", "scaleFactor_LepTRIGGER"]
+
+# Named weight variations, each filled as its own histogram in the same pass as the nominal weight
+#   'drop'  - weight branches left out of the product
+#   'scale' - factors applied to individual weight branches
+#   'lumi'  - factor applied to the luminosity
+#   'xsec'  - factors applied to the cross-section of the named samples ('*' for every sample)
+variations = {
+    'pileup_off' : {'drop': ['scaleFactor_PILEUP']},
+    'ele_sf_up' : {'scale': {'scaleFactor_ELE': 1.02}},
+    'ele_sf_down' : {'scale': {'scaleFactor_ELE': 0.98}},
+    'muon_sf_up' : {'scale': {'scaleFactor_MUON': 1.02}},
+    'muon_sf_down' : {'scale': {'scaleFactor_MUON': 0.98}},
+    'lumi_up' : {'lumi': 1.017},
+    'lumi_down' : {'lumi': 0.983},
+    'ZZ_xsec_up' : {'xsec': {'llll': 1.1}},
+    'ZZ_xsec_down' : {'xsec': {'llll': 0.9}},
+}
+
+samples = {
+
+    'data': {
+        'list' : ['data_A','data_B','data_C','data_D'], # data is from 2016, first four periods of data taking (ABCD)
+    },
+
+    r'Background $Z,t\bar{t}$' : { # Z + ttbar
+        'list' : ['Zee','Zmumu','ttbar_lep'],
+        'color' : "#6b59d3" # purple
+    },
+
+    r'Background $ZZ^*$' : { # ZZ
+        'list' : ['llll'],
+        'color' : "#ff0000" # red
+    },
+
+    r'Signal ($m_H$ = 125 GeV)' : { # H -> ZZ -> llll
+        'list' : ['ggH125_ZZ4lep','VBFH125_ZZ4lep','WH125_ZZ4lep','ZH125_ZZ4lep'],
+        'color' : "#00cdff" # light blue
+    },
+
+}
+
+def narrowed(layout):
+    if isinstance(layout, ak.contents.NumpyArray):
+        return ak.contents.NumpyArray(layout.data.astype(compute_dtype if layout.data.dtype.kind == 'f' else np.int32))
+    # Lists get int32 offsets too, as no chunk holds 2**31 leptons
+    layout = layout.to_ListOffsetArray64(True)
+    return ak.contents.ListOffsetArray(ak.index.Index32(layout.offsets.data.astype(np.int32)), narrowed(layout.content))
+
+def with_dtypes(events):
+    """The events with floating point fields as compute_dtype and integer fields and list offsets as int32."""
+    return ak.zip({field: ak.Array(narrowed(events[field].layout)) for field in events.fields}, depth_limit=1)
+
+# Calculate invariant mass of the 4-lepton state
+# [:, i] selects the i-th lepton in each event
+def calc_mass(lep_pt, lep_eta, lep_phi, lep_E):
+    p4 = vector.zip({"pt": lep_pt, "eta": lep_eta, "phi": lep_phi, "E": lep_E})
+    invariant_mass = (p4[:, 0] + p4[:, 1] + p4[:, 2] + p4[:, 3]).M * MeV # .M calculates the invariant mass
+    return invariant_mass
+
+def calc_weight(weight_variables, sample, events, lumi, variation=None):
+    variation = variation or {}
+    info = infofile.infos[sample]
+    xsec_factors = variation.get('xsec', {})
+    xsec = info["xsec"] * xsec_factors.get(sample, xsec_factors.get('*', 1.0))
+    xsec_weight = (lumi*variation.get('lumi', 1.0)*1000*xsec)/(info["sumw"]*info["red_eff"]) #*1000 to go from fb-1 to pb-1
+    total_weight = xsec_weight 
+    for variable in weight_variables:
+        if variable in variation.get('drop', []):
+            continue
+        total_weight = total_weight * events[variable] * variation.get('scale', {}).get(variable, 1.0)
+    return total_weight
+
+def fill_variations(data, sample, lumi):
+    # One histogram per weight variation from the events that already passed the cuts, all filled together
+    weights = {name: ak.to_numpy(calc_weight(weight_variables, sample, data, lumi, variation)) for name, variation in variations.items()}
+    return histograms.fill_categories(ak.to_numpy(data['mass']), weights)
+
+def process_sample(data, cuts=None, step_size = 1000000, cutflow=None):
+    # Define empty list to hold all data for this sample
+    sample_data = []
+    # Perform the cuts for each data entry in the tree
+    # We can use data[~boolean] to remove entries from the data set
+
+    data['leading_lep_pt'] = data['lep_pt'][:,0]
+    data['sub_leading_lep_pt'] = data['lep_pt'][:,1]
+    data['third_leading_lep_pt'] = data['lep_pt'][:,2]
+    data['last_lep_pt'] = data['lep_pt'][:,3]
+    
+    # Keep the events passing every cut of the run's selection, counting them into the cutflow if given
+    data = data[selection.mask(data, cuts, cutflow)]
+
+    data['mass'] = calc_mass(data['lep_pt'], data['lep_eta'], data['lep_phi'], data['lep_E'])
+
+    # Append data to the whole sample data list
+    sample_data.append(data)
+
+    return ak.concatenate(sample_data)
+
+def mc_process_sample(data, value, lumi, cuts=None, step_size = 1000000, cutflow=None):
+    sample_data = []
+
+    data['leading_lep_pt'] = data['lep_pt'][:,0]
+    data['sub_leading_lep_pt'] = data['lep_pt'][:,1]
+    data['third_leading_lep_pt'] = data['lep_pt'][:,2]
+    data['last_lep_pt'] = data['lep_pt'][:,3]
+    
+        # Monte Carlo weights of every event, so the cutflow sums them before each cut
+    weights = calc_weight(weight_variables, value, data, lumi)
+
+        # Cuts
+    keep = selection.mask(data, cuts, cutflow, ak.to_numpy(weights) if cutflow is not None else None)
+    data = data[keep]
+        
+        # Invariant Mass
+    data['mass'] = calc_mass(data['lep_pt'], data['lep_eta'], data['lep_phi'], data['lep_E'])
+
+        # Store Monte Carlo weights in the data
+    data['totalWeight'] = weights[keep]
+
+        # Append data to the whole sample data list
+    sample_data.append(data)
+
+    # turns sample_data back into an awkward array
+    return ak.concatenate(sample_data)
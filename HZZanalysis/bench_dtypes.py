@@ -0,0 +1,72 @@
+"""Check that the float32 compute path gives the same m4l histograms as float64, and what it saves
+
+Each sample is encoded as the producer sends it, then processed as the float64 and int64 arrays JSON
+decodes to, as consumers did before, and cast to the analysis dtypes with COMPUTE_DTYPE=float32, and
+the histograms, memory and time of both are compared, e.g.
+    python bench_dtypes.py /data/4lep/ --samples data_A,Zee,ggH125_ZZ4lep
+Exits with an error if a plotted bin differs by more than --tolerance of the tallest bin.
+"""
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import awkward as ak
+import analysis
+import histograms
+import producer
+
+parser = argparse.ArgumentParser(description="Compare the m4l histograms and memory of the float32 and float64 compute paths")
+parser.add_argument('href', help="folder or URL holding Data/ and MC/ as on the open data server")
+parser.add_argument('--samples', default='data_A,Zee,ggH125_ZZ4lep', help="comma separated sample names")
+parser.add_argument('--lumi', type=float, default=10)
+parser.add_argument('--binning', default='80,250,5', help="plotted xmin,xmax,step in GeV the histograms are compared at")
+parser.add_argument('--tolerance', type=float, default=1e-5, help="largest allowed difference of a plotted bin, as a fraction of the tallest bin")
+args = parser.parse_args()
+
+def process(data, val, useweight, cast):
+    """Histogram, bytes of the events, peak bytes traced while processing them and seconds of decoding
+    and processing a unit, cast to the float32 analysis dtypes or as decoded."""
+    start = time.perf_counter()
+    # The float64 arrays JSON decodes to are bounded by SUB_BATCH_MB in the consumers, so only the
+    # processing after the cast is traced
+    events = ak.from_json(data, line_delimited=True)
+    if cast:
+        events = analysis.with_dtypes(events)
+    event_bytes = events.nbytes
+    tracemalloc.start()
+    if useweight:
+        selected = analysis.mc_process_sample(events, val, args.lumi)
+        hist = histograms.fill(ak.to_numpy(selected['mass']), ak.to_numpy(selected['totalWeight']))
+    else:
+        selected = analysis.process_sample(events)
+        hist = histograms.fill(ak.to_numpy(selected['mass']))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    seconds = time.perf_counter() - start
+    return hist, event_bytes, peak, seconds
+
+if __name__ == '__main__':
+    analysis.compute_dtype = np.dtype('float32')
+    producer.path = args.href
+    xmin, xmax, step = (float(x) for x in args.binning.split(','))
+    print(f"{'sample':<16}{'events':>8}{'MB f64':>8}{'MB f32':>8}{'peak f64':>10}{'peak f32':>10}{'s f64':>7}{'s f32':>7}"
+          f"{'sumw diff':>11}{'moved':>7}{'max bin diff':>14}")
+    worst = 0
+    for val in [name for name in args.samples.split(',') if name]:
+        useweight = not val.startswith('data')
+        tree = producer.get_MC_tree(val) if useweight else producer.get_tree(val)
+        data = ak.to_json(tree.arrays(producer.branches(useweight), library="ak"), line_delimited=True)
+        hist64, bytes64, peak64, seconds64 = process(data, val, useweight, False)
+        hist32, bytes32, peak32, seconds32 = process(data, val, useweight, True)
+        # Masses on a bin edge can land in the next bin, so compare the sums and the plotted bins
+        sumw_diff = abs(hist32[0].sum() - hist64[0].sum()) / max(abs(hist64[0].sum()), 1e-300)
+        moved = f"{np.abs(hist32[0] - hist64[0]).sum() / 2:.0f}" if not useweight else "-" # events in another base bin
+        _, plotted64 = histograms.rebin(hist64, xmin, xmax, step)
+        _, plotted32 = histograms.rebin(hist32, xmin, xmax, step)
+        bin_diff = np.abs(plotted32[0] - plotted64[0]).max() / max(plotted64[0].max(), 1e-300)
+        worst = max(worst, bin_diff)
+        print(f"{val:<16}{tree.num_entries:>8}{bytes64 / 1024**2:>8.1f}{bytes32 / 1024**2:>8.1f}{peak64 / 1024**2:>10.1f}"
+              f"{peak32 / 1024**2:>10.1f}{seconds64:>7.2f}{seconds32:>7.2f}{sumw_diff:>11.1e}{moved:>7}{bin_diff:>14.1e}")
+    if worst > args.tolerance:
+        raise SystemExit(f"plotted bins differ by up to {worst:.1e} of the tallest bin, more than {args.tolerance:.0e}")
+    print(f"plotted bins agree within {worst:.1e} of the tallest bin")
@@ -0,0 +1,62 @@
+"""Compare the bincount histogram fill and its binary encoding with np.histogram and the JSON lists they replace
+
+    python bench_histograms.py --events 1000000
+"""
+import argparse
+import json
+import time
+import numpy as np
+import analysis
+import histograms
+
+parser = argparse.ArgumentParser(description="Time histogram filling and measure encoded sizes")
+parser.add_argument('--events', type=int, default=1000000, help="masses filled in each repetition")
+parser.add_argument('--repeat', type=int, default=10)
+args = parser.parse_args()
+
+def np_histogram_fill(values, weights=None):
+    # The fill this module had before, one np.histogram per sum
+    sumw, _ = np.histogram(values, bins=histograms.base_edges, weights=weights)
+    sumw2 = sumw if weights is None else np.histogram(values, bins=histograms.base_edges, weights=weights**2)[0]
+    return np.array([sumw, sumw2], dtype=float)
+
+def json_encode(hist):
+    index = np.flatnonzero((hist != 0).any(axis=0))
+    return json.dumps({"index": index.tolist(), "sumw": hist[0, index].tolist(), "sumw2": hist[1, index].tolist()})
+
+def timed(function, *function_args):
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        result = function(*function_args)
+    return (time.perf_counter() - start) / args.repeat, result
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(1)
+    # Mostly a falling spectrum with a peak, a few values outside the base range and on bin edges
+    mass = np.concatenate([rng.exponential(150, args.events - args.events // 10), rng.normal(125, 2, args.events // 10)])
+    mass[::1000] = np.arange(len(mass[::1000])) * histograms.base_step
+    weights = rng.normal(1e-3, 2e-4, len(mass))
+    variations = {name: weights * rng.uniform(0.9, 1.1) for name in analysis.variations}
+
+    print(f"{'fill of ' + str(args.events) + ' events':<36}{'np.histogram ms':>16}{'bincount ms':>13}{'speedup':>9}")
+    for label, old, new in [
+            ("unweighted", lambda: np_histogram_fill(mass), lambda: histograms.fill(mass)),
+            ("weighted", lambda: np_histogram_fill(mass, weights), lambda: histograms.fill(mass, weights)),
+            (f"{len(variations)} weight variations", lambda: {name: np_histogram_fill(mass, w) for name, w in variations.items()},
+             lambda: histograms.fill_categories(mass, variations))]:
+        old_seconds, old_result = timed(old)
+        new_seconds, new_result = timed(new)
+        pairs = zip(old_result.values(), new_result.values()) if isinstance(old_result, dict) else [(old_result, new_result)]
+        # np.histogram with explicit edges sums weights through a cumulative sum, so allow for its rounding
+        assert all(np.allclose(a, b, rtol=1e-12, atol=1e-15 * np.abs(a).sum()) for a, b in pairs), label
+        print(f"{label:<36}{old_seconds * 1000:>16.1f}{new_seconds * 1000:>13.1f}{old_seconds / new_seconds:>8.1f}x")
+
+    print()
+    print(f"{'encoded histogram':<36}{'JSON bytes':>16}{'binary bytes':>13}{'ratio':>9}")
+    for label, hist in [("unweighted, 2000 events", histograms.fill(mass[:2000])),
+                        ("weighted, 2000 events", histograms.fill(mass[:2000], weights[:2000])),
+                        (f"weighted, {args.events} events", histograms.fill(mass, weights))]:
+        encoded = histograms.encode(hist)
+        assert np.array_equal(histograms.decode(encoded), hist)
+        old_size, new_size = len(json_encode(hist)), len(json.dumps(encoded))
+        print(f"{label:<36}{old_size:>16}{new_size:>13}{old_size / new_size:>8.1f}x")
@@ -0,0 +1,87 @@
+"""Compare uproot's HTTP source with RemoteSource on files served over a local HTTP server
+
+The server answers Range requests and can add a delay to every request to stand in for the
+round trip to the open data server, e.g.
+    python bench_remote.py /data/4lep --samples data_A,Zee --latency-ms 20
+"""
+import argparse
+import functools
+import os
+import re
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import uproot
+import infofile
+import producer
+import remote
+
+parser = argparse.ArgumentParser(description="Time reading the analysis branches through uproot's HTTP source and RemoteSource")
+parser.add_argument('directory', help="local folder holding Data/ and MC/ as on the open data server")
+parser.add_argument('--samples', default='data_A,Zee', help="comma separated sample names")
+parser.add_argument('--latency-ms', type=float, default=0, help="delay added to every request")
+parser.add_argument('--step-size', default='4 MB', help="uproot iterate step size")
+args = parser.parse_args()
+
+range_header = re.compile(r'bytes=(\d+)-(\d*)$')
+requests_served = []
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """SimpleHTTPRequestHandler with single byte ranges and a per-request delay."""
+
+    def log_message(self, format, *log_args):
+        pass
+
+    def send_head(self):
+        time.sleep(args.latency_ms / 1000)
+        requests_served.append(1)
+        match = range_header.match(self.headers.get('Range', ''))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        stop = min(int(match.group(2)) + 1 if match.group(2) else size, size)
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', f'bytes {start}-{stop - 1}/{size}')
+        self.send_header('Content-Length', str(stop - start))
+        self.end_headers()
+        self.remaining = stop - start
+        return f
+
+    def copyfile(self, source, outputfile):
+        if not hasattr(self, 'remaining'):
+            return super().copyfile(source, outputfile)
+        outputfile.write(source.read(self.remaining))
+
+def file_name(val):
+    if val in infofile.infos and not val.startswith('data'):
+        return "MC/mc_" + str(infofile.infos[val]["DSID"]) + "." + val + ".4lep.root"
+    return "Data/" + val + ".4lep.root"
+
+def read_all(url, useweight, **options):
+    requests_served.clear()
+    start = time.perf_counter()
+    entries = 0
+    with uproot.open(url + ":mini;1", **options) as tree:
+        for chunk in tree.iterate(producer.branches(useweight), library="ak", step_size=args.step_size):
+            entries += len(chunk)
+    return time.perf_counter() - start, len(requests_served), entries
+
+if __name__ == '__main__':
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(RangeHandler, directory=args.directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    href = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    print(f"{'sample':<16}{'entries':>10}{'uproot s':>10}{'requests':>10}{'remote s':>10}{'requests':>10}{'speedup':>9}")
+    for val in [name for name in args.samples.split(',') if name]:
+        url = href + file_name(val)
+        useweight = not val.startswith('data')
+        default_seconds, default_requests, entries = read_all(url, useweight)
+        remote_seconds, remote_requests, _ = read_all(url, useweight, handler=remote.RemoteSource)
+        print(f"{val:<16}{entries:>10}{default_seconds:>10.2f}{default_requests:>10}{remote_seconds:>10.2f}{remote_requests:>10}"
+              f"{default_seconds / remote_seconds:>8.1f}x")
+    server.shutdown()
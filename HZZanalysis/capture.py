@@ -0,0 +1,36 @@
+"""Recording the messages consumers and the collector handle, to replay them with replay.py
+
+With CAPTURE_DIR set, every task a consumer takes and every run announcement, control message and
+result the collector takes is appended to {CAPTURE_DIR}/{role}-{host}-{pid}.jsonl, one JSON line per
+message with the queue, the time it arrived, the seconds its callback took and the body.
+"""
+import os
+import json
+import time
+import socket
+import metrics
+
+capture_dir = os.getenv('CAPTURE_DIR')
+capture_files = {} # role -> open capture file
+
+def record(queue, arrived, seconds, body):
+    if metrics.role not in capture_files:
+        os.makedirs(capture_dir, exist_ok=True)
+        capture_files[metrics.role] = open(os.path.join(capture_dir, f"{metrics.role}-{socket.gethostname()}-{os.getpid()}.jsonl"), 'a')
+    capture_file = capture_files[metrics.role]
+    capture_file.write(json.dumps({"queue": queue, "time": arrived, "seconds": seconds,
+                                   "body": body.decode() if isinstance(body, bytes) else body}) + '\n')
+    capture_file.flush()
+
+def recorded(queue, callback):
+    """The callback for messages from queue, recording each message first if CAPTURE_DIR is set."""
+    if not capture_dir:
+        return callback
+    def wrapper(ch, method, properties, body):
+        arrived = time.time()
+        start_time = time.perf_counter()
+        try:
+            return callback(ch, method, properties, body)
+        finally:
+            record(queue, arrived, time.perf_counter() - start_time, body)
+    return wrapper
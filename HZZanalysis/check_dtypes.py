@@ -0,0 +1,83 @@
+"""Check that the float32 compute path gives the same m4l histograms as float64, without any data files
+
+Synthetic events with four to six leptons are stored as float32 like the ROOT branches, encoded as
+the producer sends them and processed as a consumer does with COMPUTE_DTYPE float64 and float32.
+Exits with an error if a mass differs by more than --mass-tolerance, the sums of weights by more than
+--tolerance or more than --max-moved of the events are in another plotted bin, as masses right on an
+edge can be, e.g.
+    python check_dtypes.py --events 200000
+For the memory and time saved on real samples see bench_dtypes.py.
+"""
+import argparse
+import numpy as np
+import awkward as ak
+import analysis
+import histograms
+
+parser = argparse.ArgumentParser(description="Compare the m4l histograms of the float32 and float64 compute paths on synthetic events")
+parser.add_argument('--events', type=int, default=100000)
+parser.add_argument('--sample', default='llll', help="Monte Carlo sample whose cross-section and sum of weights are used")
+parser.add_argument('--lumi', type=float, default=10)
+parser.add_argument('--binning', default='80,250,5', help="plotted xmin,xmax,step in GeV the histograms are compared at")
+parser.add_argument('--tolerance', type=float, default=1e-5, help="largest allowed relative difference of the sum of weights")
+parser.add_argument('--mass-tolerance', type=float, default=1e-4, help="largest allowed relative difference of a mass, "
+                                                                      "as E^2 - p^2 cancels in float32")
+parser.add_argument('--max-moved', type=float, default=1e-3, help="largest allowed fraction of the events in another plotted bin")
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+def synthetic_events(num_events, rng):
+    """Events with the analysis branches, in the dtypes of the ROOT files."""
+    counts = rng.choice([4, 4, 4, 5, 6], num_events)
+    total = counts.sum()
+    flavour = rng.choice([11, 13], total)
+    pt = rng.exponential(30000, total) + 5000 # MeV
+    eta = rng.uniform(-2.5, 2.5, total)
+    mass = np.where(flavour == 11, 0.511, 105.66)
+    columns = {
+        'lep_pt': pt, 'lep_eta': eta, 'lep_phi': rng.uniform(-np.pi, np.pi, total),
+        'lep_E': np.sqrt((pt * np.cosh(eta))**2 + mass**2),
+        'lep_charge': rng.choice([-1, 1], total), 'lep_type': flavour,
+    }
+    events = {name: ak.unflatten(values.astype(np.float32 if values.dtype.kind == 'f' else np.int32), counts)
+              for name, values in columns.items()}
+    for name in analysis.weight_variables:
+        events[name] = rng.normal(1, 0.05, num_events).astype(np.float32)
+    return ak.zip(events, depth_limit=1)
+
+def process(data, dtype, useweight):
+    """Fine histogram and masses of the encoded events, processed with the given compute dtype."""
+    analysis.compute_dtype = np.dtype(dtype)
+    events = analysis.with_dtypes(ak.from_json(data, line_delimited=True))
+    if useweight:
+        selected = analysis.mc_process_sample(events, args.sample, args.lumi)
+        hist = histograms.fill(ak.to_numpy(selected['mass']), ak.to_numpy(selected['totalWeight']))
+    else:
+        selected = analysis.process_sample(events)
+        hist = histograms.fill(ak.to_numpy(selected['mass']))
+    return hist, ak.to_numpy(selected['mass'])
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(args.seed)
+    data = ak.to_json(synthetic_events(args.events, rng), line_delimited=True)
+    xmin, xmax, step = (float(x) for x in args.binning.split(','))
+    failures = []
+    for label, useweight in [("data", False), (f"Monte Carlo ({args.sample})", True)]:
+        hist64, mass64 = process(data, 'float64', useweight)
+        hist32, mass32 = process(data, 'float32', useweight)
+        if (mass64.dtype, mass32.dtype) != (np.float64, np.float32):
+            failures.append(f"{label}: masses computed as {mass64.dtype} and {mass32.dtype}")
+        # The cuts only read integers, so both select the same events in the same order
+        mass_diff = np.max(np.abs(mass32 - mass64) / mass64)
+        sumw_diff = abs(hist32[0].sum() - hist64[0].sum()) / abs(hist64[0].sum())
+        _, plotted64 = histograms.rebin(hist64, xmin, xmax, step)
+        _, plotted32 = histograms.rebin(hist32, xmin, xmax, step)
+        moved = np.abs(plotted32[0] - plotted64[0]).sum() / 2 / plotted64[0].sum()
+        print(f"{label:<20} {len(mass64):>8} selected, masses differ by up to {mass_diff:.1e}, sum of weights by {sumw_diff:.1e}, "
+              f"{moved:.1e} of the events in another plotted bin")
+        if not mass_diff <= args.mass_tolerance or not sumw_diff <= args.tolerance or not moved <= args.max_moved:
+            failures.append(f"{label}: float32 and float64 histograms do not agree")
+    analysis.compute_dtype = np.dtype('float32')
+    if failures:
+        raise SystemExit("\n".join(failures))
+    print("float32 and float64 histograms agree")
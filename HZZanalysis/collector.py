@@ -1,6 +1,5 @@
 import pika
 import json
-import awkward as ak
 import os
 import logging
 import time
@@ -8,9 +7,15 @@ import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from matplotlib.ticker import AutoMinorLocator # for minor ticks
 
 import subprocess
+import broker
+import capture
+import histograms
+import metrics
+import plotting
+import profiling
+import selection
 
 from collections import defaultdict
 
@@ -19,21 +24,37 @@ if debug:
     logging.basicConfig(level=logging.INFO, handlers=[logging.StreamHandler()])
 else:
     logging.basicConfig(level=logging.WARNING, handlers=[logging.StreamHandler()])
-data_chunks = defaultdict(list)
-mc_data_chunks = defaultdict(list)
-all_data = defaultdict(list)
 
 MeV = 0.001
 GeV = 1.0
 
-expected_chunks = 0
-expected_mc_chunks = 0
-received = 0
-mc_received = 0
-
-lumi = 10.0
 fraction = 1.0
 
+# Plotted binning, rebinned from the fine histograms accumulated during the run
+plot_xmin = float(os.getenv('PLOT_XMIN', 80)) * GeV
+plot_xmax = float(os.getenv('PLOT_XMAX', 250)) * GeV
+plot_step = float(os.getenv('PLOT_STEP', 5)) * GeV
+
+# Plots, the histograms behind them and the cutflow of each sample are written to OUTPUT_DIR
+output_dir = os.getenv('OUTPUT_DIR', '/app/logs')
+
+# In service mode the collector, consumers and broker stay up between runs
+service_mode = os.getenv('SERVICE_MODE', 'False').lower() == 'true'
+
+# Every CHECKPOINT_INTERVAL seconds (0 disables) the state of each run that changed is written to
+# CHECKPOINT_DIR, and a restarted collector resumes those runs instead of starting them again
+checkpoint_dir = os.getenv('CHECKPOINT_DIR', '/app/logs/checkpoints')
+checkpoint_interval = float(os.getenv('CHECKPOINT_INTERVAL', 30))
+# Checkpoints older than CHECKPOINT_TTL seconds, or whose producer is gone, are deleted rather than
+# resumed, and a resumed run whose producer has not answered within RESUME_TIMEOUT seconds is set
+# aside, so runs interrupted for good do not keep the collector waiting
+checkpoint_ttl = float(os.getenv('CHECKPOINT_TTL', 24 * 3600))
+resume_timeout = float(os.getenv('RESUME_TIMEOUT', 60))
+
+# Every PROGRESS_INTERVAL seconds (0 disables) the events processed, throughput and estimated time
+# left of each sample are logged and set on the hzz_processed_events and hzz_eta_seconds gauges
+progress_interval = float(os.getenv('PROGRESS_INTERVAL', 10))
+
 samples = {
 
     'data': {
@@ -57,208 +78,384 @@ samples = {
 
 }
 
+class Run:
+    """Everything the collector accumulates for one analysis run"""
+    def __init__(self, run_id, lumi, start_time):
+        self.run_id = run_id
+        self.lumi = lumi
+        self.start_time = start_time
+        self.hists = {} # sample -> fine histogram
+        self.groups = {} # sample -> identifier of the group it is plotted in
+        self.variations = defaultdict(dict) # sample -> variation name -> fine histogram
+        self.expected_chunks = None
+        self.expected_mc_chunks = None
+        self.received = 0
+        self.mc_received = 0
+        self.completed = set() # ids of the work units already added, so a unit sent twice counts once
+        self.plan = {} # sample -> events and work units the producer is sending
+        self.processed = defaultdict(int) # sample -> events of the added work units
+        self.first_result = {} # sample -> time its first result was added
+        self.cuts = list(selection.cuts) # names of the cuts, in the order they are applied
+        self.cutflows = {} # sample -> events and sum of weights in total and after each cut
+        self.changed = False # since the last checkpoint
+        self.checkpoint_time = None # when the checkpoint a resumed run was loaded from was written
+        self.awaiting_producer = False # resumed and its producer has not answered yet
+        self.consumer_tags = []
+
+    def complete(self):
+        return (self.expected_chunks is not None and self.expected_mc_chunks is not None
+                and self.received >= self.expected_chunks and self.mc_received >= self.expected_mc_chunks)
+
+# Runs currently being collected, keyed by run id
+runs = {}
+
 # Plotting functions
-def setup_plot(ax, xmin, xmax, step_size, y_max):
-    """Configure plot settings."""
-    ax.set_xlim(xmin, xmax)
-    ax.set_ylim(0, y_max * 1.6)
-    ax.set_xlabel(r'4-lepton invariant mass $\mathrm{m_{4l}}$ [GeV]', fontsize=13, x=1, horizontalalignment='right')
-    ax.set_ylabel(f'Events / {step_size} GeV', y=1, horizontalalignment='right')
-    ax.tick_params(which='both', direction='in', top=True, right=True)
-    ax.xaxis.set_minor_locator(AutoMinorLocator())
-    ax.yaxis.set_minor_locator(AutoMinorLocator())
-
-def save_plot():
+def save_plot(run_id):
     timestamp = time.time()
     local_time = time.localtime(timestamp)
-    name = time.strftime("%d-%m-%Y %H-%M", local_time)
+    name = time.strftime("%d-%m-%Y %H-%M", local_time) + f" {run_id}" # runs finishing in the same minute must not overwrite each other
         
-    plt.savefig(f'/app/logs/{name}.png')
+    plt.savefig(os.path.join(output_dir, f'{name}.png'))
     plt.close()
     logging.info(f'plot saved as {name}.png')
+    return f'{name}.png'
     
+def get_run(message):
+    run = runs.get(message["run_id"])
+    if run is None:
+        logging.info(f"Dropping message for unknown run {message['run_id']}")
+    return run
+
+def subscribe(ch, run):
+    broker.declare_run_queues(ch, run.run_id)
+    for name, on_message in [('control_queue', callback_control), ('result_queue', callback), ('mc_result_queue', mc_callback)]:
+        queue = broker.run_queue(name, run.run_id)
+        run.consumer_tags.append(ch.basic_consume(queue=queue, on_message_callback=capture.recorded(queue, on_message),
+                                                  auto_ack=name == 'control_queue'))
+
+# Callback function for a newly announced run
+def callback_run(ch, method, properties, body):
+    message = json.loads(body)
+    run_id = message["run_id"]
+    run = Run(run_id, message["lumi"], message["start_time"])
+    run.cuts = message.get("cuts") or run.cuts
+    runs[run_id] = run
+    subscribe(ch, run)
+    # runs_queue is acknowledged on delivery, so the run is written down before anything else can be lost
+    if checkpoint_interval:
+        save_checkpoint(run)
+    logging.info(f"Collecting run {run_id}")
+
+# Checkpointing
+def checkpoint_path(run_id):
+    return os.path.join(checkpoint_dir, f"{run_id}.json")
+
+def save_checkpoint(run):
+    state = {
+        "run_id": run.run_id, "lumi": run.lumi, "start_time": run.start_time, "time": time.time(),
+        "expected_chunks": run.expected_chunks, "expected_mc_chunks": run.expected_mc_chunks,
+        "received": run.received, "mc_received": run.mc_received, "completed": sorted(run.completed),
+        "plan": run.plan,
+        "cuts": run.cuts,
+        "cutflows": {val: cutflow.tolist() for val, cutflow in run.cutflows.items()},
+        "groups": run.groups,
+        "hists": {val: histograms.encode(hist) for val, hist in run.hists.items()},
+        "variations": {val: {name: histograms.encode(hist) for name, hist in hists.items()} for val, hists in run.variations.items()},
+    }
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    # Written to a temporary file first so a crash mid-write leaves the previous checkpoint intact
+    path = checkpoint_path(run.run_id)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+    run.changed = False
+
+def load_checkpoint(path):
+    with open(path) as f:
+        state = json.load(f)
+    run = Run(state["run_id"], state["lumi"], state["start_time"])
+    run.expected_chunks = state["expected_chunks"]
+    run.expected_mc_chunks = state["expected_mc_chunks"]
+    run.received = state["received"]
+    run.mc_received = state["mc_received"]
+    run.completed = set(state["completed"])
+    run.checkpoint_time = state.get("time", os.path.getmtime(path))
+    set_plan(run, state.get("plan") or {})
+    for unit in run.completed:
+        run.processed[unit.rpartition(':')[0]] += unit_events(unit)
+    run.groups = state["groups"]
+    run.cuts = state.get("cuts", run.cuts)
+    run.cutflows = {val: np.array(cutflow) for val, cutflow in state.get("cutflows", {}).items()}
+    run.hists = {val: histograms.decode(hist) for val, hist in state["hists"].items()}
+    for val, hists in state["variations"].items():
+        run.variations[val] = {name: histograms.decode(hist) for name, hist in hists.items()}
+    return run
+
+def checkpoint():
+    for run in list(runs.values()):
+        if run.changed:
+            with metrics.timed('checkpoint'):
+                save_checkpoint(run)
+    connection.call_later(checkpoint_interval, checkpoint)
+
+def queue_exists(queue):
+    # A passive declare of a missing queue closes the channel, so it is made on one of its own
+    probe = connection.channel()
+    try:
+        probe.queue_declare(queue=queue, passive=True)
+    except pika.exceptions.ChannelClosedByBroker:
+        return False
+    probe.close()
+    return True
+
+def resume_runs():
+    """Pick up the runs checkpointed by a previous collector whose producer is still waiting."""
+    if not os.path.isdir(checkpoint_dir):
+        return
+    for name in sorted(os.listdir(checkpoint_dir)):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(checkpoint_dir, name)
+        run = load_checkpoint(path)
+        # The producer of a run deletes its schedule queue when it stops
+        if time.time() - run.checkpoint_time > checkpoint_ttl or not queue_exists(broker.run_queue('schedule_queue', run.run_id)):
+            logging.warning(f"Deleting the checkpoint of run {run.run_id}, its producer is gone")
+            os.remove(path)
+            continue
+        runs[run.run_id] = run
+        run.awaiting_producer = True
+        subscribe(channel, run)
+        logging.info(f"Resuming run {run.run_id} with {len(run.completed)} work units done")
+        request_missing(run)
+
+def request_missing(run):
+    # Results already waiting in the run's queues are added first, then the producer is asked to
+    # send again the units lost since the checkpoint that are neither in it nor among those results
+    if run.run_id not in runs:
+        return
+    waiting = sum(channel.queue_declare(queue=broker.run_queue(name, run.run_id), passive=True).method.message_count
+                  for name in broker.run_queues)
+    if waiting:
+        connection.call_later(1, lambda: request_missing(run))
+        return
+    channel.basic_publish(exchange='', routing_key=broker.run_queue('schedule_queue', run.run_id),
+                          body=json.dumps({"run_id": run.run_id, "type": "resend", "checkpoint_time": run.checkpoint_time,
+                                           "completed": sorted(run.completed)}),
+                          properties=pika.BasicProperties(delivery_mode=2))
+    logging.info(f"Asked for the missing work units of run {run.run_id}")
+    connection.call_later(resume_timeout, lambda: check_answered(run))
+
+def check_answered(run):
+    # Its checkpoint is kept, so a later collector can still resume it until it expires
+    if runs.get(run.run_id) is run and run.awaiting_producer:
+        logging.warning(f"Setting run {run.run_id} aside, its producer did not answer within {resume_timeout:.0f} s")
+        forget_run(channel, run)
+        shut_down_if_idle(channel)
+
 # Callback function for determining how many chunks should be waited for before plotting graph
-def callback_chunks(ch, method, properties, body):
-    global expected_chunks
-    global all_data
-    expected_chunks = json.loads(body)
-    logging.info(f"{expected_chunks} chunks expected")
-    while True:
-        if received >= expected_chunks:
-            # Histogram settings
-            for identifier, chunks in data_chunks.items():
-                all_data[identifier] = ak.concatenate(chunks)
-            break
-
-def callback_mc_chunks(ch, method, properties, body):
-    global expected_mc_chunks
-    expected_mc_chunks = json.loads(body)
-    logging.info(f"{expected_mc_chunks} mc chunks expected")
-    
-# Callback function for timing purposes
-def callback_time(ch, method, properties, body):
-    start_time = json.loads(body)
-    end_time = time.time()
-    total_time = end_time - start_time
-    logging.info(f"{total_time} time elapsed")
-    
-    
-# Callback function for received data
+@profiling.profiled('collector.callback_control')
+def callback_control(ch, method, properties, body):
+    message = json.loads(body)
+    run = get_run(message)
+    if run is None:
+        return
+    if message["type"] == "failed":
+        fail_run(ch, run, message)
+        return
+    run.changed = True
+    # Only the producer sends the other control messages, so a resumed run is live
+    run.awaiting_producer = False
+    if message["type"] == "plan":
+        set_plan(run, message["samples"])
+        logging.info(f"Run {run.run_id} plans {sum(p['events'] for p in run.plan.values())} events")
+    elif message["type"] == "chunks":
+        run.expected_chunks = message["chunks"]
+        logging.info(f"{run.expected_chunks} chunks expected")
+    elif message["type"] == "mc_chunks":
+        run.expected_mc_chunks = message["chunks"]
+        logging.info(f"{run.expected_mc_chunks} mc chunks expected")
+    check_complete(ch, run)
+
+# Callback function for received data, each message holds the results of one or more work units
+@profiling.profiled('collector.callback')
 def callback(ch, method, properties, body):
-    global received
-    global data_chunks
-    
     message = json.loads(body)
-    data = ak.from_json(message["data"])
-    identifier = message["identifier"]
-    #data = {"data":data, "identifier":identifier}
+    run = get_run(message)
+    if run is None:
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+    with metrics.timed('decode'):
+        results = [(result, histograms.decode(result["hist"])) for result in message["results"]]
+    metrics.count('result_queue', body, sum(result["events"] for result in message["results"]))
     
     logging.info("Processing received data chunk:")
 
-    #all_data[identifier] = ak.concatenate([all_data[identifier],data])
-    data_chunks[identifier].append(data)
-    received += 1
-
-    logging.info(str(received) + " " + str(expected_chunks))
-    
-        
-
+    added = []
+    for result, hist in results:
+        if not accept(ch, run, result):
+            continue
+        added += result["units"]
+        run.groups[result["val"]] = result["identifier"]
+        accumulate(run.hists, result["val"], hist)
+        if "cutflow" in result:
+            accumulate(run.cutflows, result["val"], np.array(result["cutflow"]))
+        run.received += len(result["units"])
+
+    logging.info(str(run.received) + " " + str(run.expected_chunks))
+    notify_completed(ch, run, added)
+    # Only acknowledged once the producer has been told, so no result is lost without its units being reported
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+    check_complete(ch, run)
+
+@profiling.profiled('collector.mc_callback')
 def mc_callback(ch, method, properties, body):
-    global mc_received
-    global mc_data_chunks
-    
     message = json.loads(body)
-    data = ak.from_json(message["data"])
-    identifier = message["identifier"]
+    run = get_run(message)
+    if run is None:
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+    with metrics.timed('decode'):
+        results = [(result, histograms.decode(result["hist"])) for result in message["results"]]
+    metrics.count('mc_result_queue', body, sum(result["events"] for result in message["results"]))
     
     logging.info("Processing mc data chunk:")
 
-    #all_data[identifier] = ak.concatenate([all_data[identifier],data])
-    mc_data_chunks[identifier].append(data)
-    mc_received += 1
-
-    logging.info("received: " + str(mc_received) + " expected:" + str(expected_mc_chunks))
-    if mc_received >= expected_mc_chunks and expected_mc_chunks != 0:
-        for identifier, chunks in mc_data_chunks.items():
-                all_data[identifier] = ak.concatenate(chunks)
+    added = []
+    for result, hist in results:
+        if not accept(ch, run, result):
+            continue
+        added += result["units"]
+        val = result["val"]
+        run.groups[val] = result["identifier"]
+        accumulate(run.hists, val, hist)
+        if "cutflow" in result:
+            accumulate(run.cutflows, val, np.array(result["cutflow"]))
+        for name, filled in result.get("variations", {}).items():
+            accumulate(run.variations[val], name, histograms.decode(filled))
+        run.mc_received += len(result["units"])
+
+    logging.info("received: " + str(run.mc_received) + " expected:" + str(run.expected_mc_chunks))
+    notify_completed(ch, run, added)
+    # Only acknowledged once the producer has been told, so no result is lost without its units being reported
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+    check_complete(ch, run)
+
+def accept(ch, run, result):
+    """Whether a partial result can be added, which is only if none of its units has been added yet
+    and none is in it twice."""
+    units = result["units"]
+    repeated = [unit for unit in units if unit in run.completed]
+    if repeated or len(set(units)) < len(units):
+        # The histograms of the other units cannot be taken out of the sum, so ask for them again
+        retry = [unit for unit in dict.fromkeys(units) if unit not in run.completed]
+        logging.info(f"Skipping a result of {len(units)} units as {len(repeated)} were already added "
+                     f"and {len(units) - len(set(units))} are in it twice")
+        if retry:
+            ch.basic_publish(exchange='', routing_key=broker.run_queue('schedule_queue', run.run_id),
+                             body=json.dumps({"run_id": run.run_id, "type": "retry", "units": retry}))
+        return False
+    run.completed.update(units)
+    run.changed = True
+    run.first_result.setdefault(result["val"], time.time())
+    run.processed[result["val"]] += sum(unit_events(unit) for unit in units)
+    return True
+
+def unit_events(unit):
+    # A unit id is {sample}:{first entry}-{entry after the last}
+    entry_start, entry_stop = map(int, unit.rpartition(':')[2].split('-'))
+    return entry_stop - entry_start
+
+# Progress
+def set_plan(run, plan):
+    run.plan = plan
+    for val, planned in plan.items():
+        metrics.planned_events.labels(run.run_id, val).set(planned["events"])
+        metrics.processed_events.labels(run.run_id, val).set(run.processed[val])
+
+def log_progress(run):
+    now = time.time()
+    planned = sum(p["events"] for p in run.plan.values())
+    processed = sum(run.processed[val] for val in run.plan)
+    rate = processed / max(now - run.start_time, 1e-9)
+    eta = (planned - processed) / rate if rate else float('inf')
+    metrics.eta_seconds.labels(run.run_id).set(eta)
+    # Printed rather than logged, so progress shows without DEBUG, and flushed as stdout is a pipe under docker
+    lines = [f"Run {run.run_id}: {processed}/{planned} events, {rate:.0f} events/s, ETA {eta:.0f} s"]
+    for val, p in run.plan.items():
+        metrics.processed_events.labels(run.run_id, val).set(run.processed[val])
+        if val in run.first_result and 0 < run.processed[val] < p["events"]:
+            # Each sample's own rate since its first result, as samples are sent one after another
+            sample_rate = run.processed[val] / max(now - run.first_result[val], 1e-9)
+            lines.append(f"  {val}: {run.processed[val]}/{p['events']} events, {sample_rate:.0f} events/s, "
+                         f"ETA {(p['events'] - run.processed[val]) / sample_rate:.0f} s")
+        else:
+            lines.append(f"  {val}: {run.processed[val]}/{p['events']} events")
+    print("\n".join(lines), flush=True)
+
+def report_progress():
+    for run in list(runs.values()):
+        if run.plan:
+            log_progress(run)
+    connection.call_later(progress_interval, report_progress)
+
+def notify_completed(ch, run, units):
+    # The producer times the units to spot stragglers and stops waiting on the ones that are done
+    if units:
+        ch.basic_publish(exchange='', routing_key=broker.run_queue('schedule_queue', run.run_id),
+                         body=json.dumps({"run_id": run.run_id, "type": "completed", "units": units, "time": time.time()}))
+
+def accumulate(store, key, hist):
+    if key in store:
+        store[key] += hist
+    else:
+        store[key] = hist
+
+def check_complete(ch, run):
+    if not run.complete():
+        return
+    with metrics.timed('plot'):
+        plot_name = plot_run(run)
+    elapsed = time.time() - run.start_time
+    logging.info(f"{elapsed} time elapsed")
+    # Tell whoever submitted the run where its plot is (dropped if nobody is waiting)
+    end_run(ch, run, {"run_id": run.run_id, "plot": plot_name, "elapsed": elapsed})
+    logging.info(f"Run {run.run_id} finished")
+
+def fail_run(ch, run, message):
+    # A consumer dropped a task it could not process, so the run can never complete
+    error = f"a task of {len(message['units'])} work units could not be processed: {message['error']}"
+    logging.error(f"Run {run.run_id} failed, {error}")
+    end_run(ch, run, {"run_id": run.run_id, "error": error, "elapsed": time.time() - run.start_time})
+
+def end_run(ch, run, outcome):
+    ch.basic_publish(exchange='', routing_key=broker.run_queue('done_queue', run.run_id), body=json.dumps(outcome))
+    # and the producer, which waits to send missing units again until the run is done
+    ch.basic_publish(exchange='', routing_key=broker.run_queue('schedule_queue', run.run_id),
+                     body=json.dumps({"run_id": run.run_id, "type": "done"}))
+    if os.path.exists(checkpoint_path(run.run_id)):
+        os.remove(checkpoint_path(run.run_id))
+
+    forget_run(ch, run)
+    broker.delete_run_queues(ch, run.run_id)
+    shut_down_if_idle(ch, run.received)
+
+def forget_run(ch, run):
+    for tag in run.consumer_tags:
+        ch.basic_cancel(tag)
+    for name in broker.run_queues:
+        metrics.queue_depth.remove(broker.run_queue(name, run.run_id))
+    for val in run.plan:
+        metrics.planned_events.remove(run.run_id, val)
+        metrics.processed_events.remove(run.run_id, val)
+    metrics.eta_seconds.remove(run.run_id)
+    del runs[run.run_id]
+
+def shut_down_if_idle(ch, received=0):
+    # The consumer pool and broker are shared, so only tear them down once no run is left but
+    # resumed ones whose producer has not answered
+    if all(run.awaiting_producer for run in runs.values()) and not service_mode:
         for i in range(received):
             channel.basic_publish(exchange='', routing_key='shutdown_queue',body=json.dumps("shutdown"))
-        # Histogram settings
-        
-        xmin, xmax = 80 * GeV, 250 * GeV
-        step_size = 5 * GeV
-        bin_edges = np.arange(xmin, xmax + step_size, step_size)
-        bin_centres = bin_edges[:-1] + step_size / 2
-
-        data_x,_ = np.histogram(ak.to_numpy(all_data['data']['mass']),bins=bin_edges ) # histogram the data
-        data_x_errors = np.sqrt( data_x ) # statistical error on the data
-
-        signal_x = ak.to_numpy(all_data[r'Signal ($m_H$ = 125 GeV)']['mass']) # histogram the signal
-        signal_weights = ak.to_numpy(all_data[r'Signal ($m_H$ = 125 GeV)'].totalWeight) # get the weights of the signal events
-        signal_color = samples[r'Signal ($m_H$ = 125 GeV)']['color'] # get the colour for the signal bar
-
-        mc_x = [] # define list to hold the Monte Carlo histogram entries
-        mc_weights = [] # define list to hold the Monte Carlo weights
-        mc_colors = [] # define list to hold the colors of the Monte Carlo bars
-        mc_labels = [] # define list to hold the legend labels of the Monte Carlo bars
-
-        for s in samples: # loop over samples
-            if s not in ['data', r'Signal ($m_H$ = 125 GeV)']: # if not data nor signal
-                mc_x.append( ak.to_numpy(all_data[s]['mass']) ) # append to the list of Monte Carlo histogram entries
-                mc_weights.append( ak.to_numpy(all_data[s].totalWeight) ) # append to the list of Monte Carlo weights
-                mc_colors.append( samples[s]['color'] ) # append to the list of Monte Carlo bar colors
-                mc_labels.append( s ) # append to the list of Monte Carlo legend labels
-        # *************
-        # Main plot 
-        # *************
-        main_axes = plt.gca() # get current axes
-
-        # plot the data points
-        main_axes.errorbar(x=bin_centres, y=data_x, yerr=data_x_errors,
-                            fmt='ko', # 'k' means black and 'o' is for circles 
-                            label='Data') 
-
-        # plot the Monte Carlo bars
-        mc_heights = main_axes.hist(mc_x, bins=bin_edges, 
-                                    weights=mc_weights, stacked=True, 
-                                    color=mc_colors, label=mc_labels )
-
-        mc_x_tot = mc_heights[0][-1] # stacked background MC y-axis value
-
-        # calculate MC statistical uncertainty: sqrt(sum w^2)
-        mc_x_err = np.sqrt(np.histogram(np.hstack(mc_x), bins=bin_edges, weights=np.hstack(mc_weights)**2)[0])
-
-        # plot the signal bar
-        signal_heights = main_axes.hist(signal_x, bins=bin_edges, bottom=mc_x_tot, 
-                        weights=signal_weights, color=signal_color,
-                        label=r'Signal ($m_H$ = 125 GeV)')
-
-        # plot the statistical uncertainty
-        main_axes.bar(bin_centres, # x
-                        2*mc_x_err, # heights
-                        alpha=0.5, # half transparency
-                        bottom=mc_x_tot-mc_x_err, color='none', 
-                        hatch="////", width=step_size, label='Stat. Unc.' )
-
-        # set the x-limit of the main axes
-        main_axes.set_xlim( left=xmin, right=xmax ) 
-
-        # separation of x axis minor ticks
-        main_axes.xaxis.set_minor_locator( AutoMinorLocator() ) 
-
-        # set the axis tick parameters for the main axes
-        main_axes.tick_params(which='both', # ticks on both x and y axes
-                                direction='in', # Put ticks inside and outside the axes
-                                top=True, # draw ticks on the top axis
-                                right=True ) # draw ticks on right axis
-
-        # x-axis label
-        main_axes.set_xlabel(r'4-lepton invariant mass $\mathrm{m_{4l}}$ [GeV]',
-                            fontsize=13, x=1, horizontalalignment='right' )
-
-        # write y-axis label for main axes
-        main_axes.set_ylabel('Events / '+str(step_size)+' GeV',
-                                y=1, horizontalalignment='right') 
-
-        # set y-axis limits for main axes
-        main_axes.set_ylim( bottom=0, top=np.amax(data_x)*1.6 )
-
-        # add minor ticks on y-axis for main axes
-        main_axes.yaxis.set_minor_locator( AutoMinorLocator() ) 
-
-        # Add text 'ATLAS Open Data' on plot
-        plt.text(0.05, # x
-                    0.93, # y
-                    'ATLAS Open Data', # text
-                    transform=main_axes.transAxes, # coordinate system used is that of main_axes
-                    fontsize=13 ) 
-
-        # Add text 'for education' on plot
-        plt.text(0.05, # x
-                    0.88, # y
-                    'for education', # text
-                    transform=main_axes.transAxes, # coordinate system used is that of main_axes
-                    style='italic',
-                    fontsize=8 ) 
-
-        # Add energy and luminosity
-        lumi_used = str(lumi*fraction) # luminosity to write on the plot
-        plt.text(0.05, # x
-                    0.82, # y
-                    '$\sqrt{s}$=13 TeV,$\int$L dt = '+lumi_used+' fb$^{-1}$', # text
-                    transform=main_axes.transAxes ) # coordinate system used is that of main_axes
-
-        # Add a label for the analysis carried out
-        plt.text(0.05, # x
-                    0.76, # y
-                    r'$H \rightarrow ZZ^* \rightarrow 4\ell$', # text 
-                    transform=main_axes.transAxes ) # coordinate system used is that of main_axes
-
-        # draw the legend
-        main_axes.legend( frameon=False ) # no box around the legend
-        save_plot()
-        plt.close()
-        
         logging.info("Shutting down...")
         ch.stop_consuming()
         ch.close()
@@ -266,38 +463,42 @@ def mc_callback(ch, method, properties, body):
         logging.info("Connection closed.")
         subprocess.Popen(['/bin/sh', '/app/shutdown.sh'])
         os.system('docker-compose stop rabbitmq')
-    
-def connect_to_rabbitmq():
-    while True:
-        try:
-            logging.info("Attempting to connect to RabbitMQ...")
-            connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
-            return connection
-        except pika.exceptions.AMQPConnectionError:
-            logging.info("Failed to connect to RabbitMQ. Retrying in 5 seconds...")
-            time.sleep(10)
-
-
-# Establish a connection to RabbitMQ
-connection = connect_to_rabbitmq()
-channel = connection.channel()
-
-# Declare the queues to consume from
-channel.queue_declare(queue='result_queue', durable=True)
-channel.queue_declare(queue='chunks_queue', durable=True)
-channel.queue_declare(queue='mc_chunks_queue', durable=True)
-channel.queue_declare(queue='time_queue', durable=True)
-channel.queue_declare(queue='shutdown_queue', durable=True)
-channel.queue_declare(queue='mc_result_queue', durable=True)
-
-
-# Start consuming messages from RabbitMQ
-channel.basic_consume(queue='chunks_queue', on_message_callback=callback_chunks, auto_ack=True)
-channel.basic_consume(queue='mc_chunks_queue', on_message_callback=callback_mc_chunks, auto_ack=True)
-channel.basic_consume(queue='result_queue', on_message_callback=callback, auto_ack=True)
-channel.basic_consume(queue='mc_result_queue', on_message_callback=mc_callback, auto_ack=True)
-channel.basic_consume(queue='time_queue', on_message_callback=callback_time, auto_ack=True)
-logging.info(f"Collector is listening for messages on 'result_queue'...")
-logging.info(f"Collector is listening for messages on 'mc_result_queue'...")
-channel.start_consuming()
 
+def plot_run(run):
+    binning = (plot_xmin, plot_xmax, plot_step)
+    plotting.plot_samples(run.hists, run.groups, run.variations, samples, run.lumi*fraction, binning)
+    plot_name = save_plot(run.run_id)
+    # The numbers behind the plot, for replot.py
+    artifact = os.path.splitext(plot_name)[0] + '.npz'
+    plotting.save_artifact(os.path.join(output_dir, artifact), run.hists, run.groups, run.variations, samples, run.lumi*fraction, binning,
+                           {"run_id": run.run_id, "start_time": run.start_time, "end_time": time.time(),
+                            "units": run.received + run.mc_received, "plan": run.plan,
+                            "cuts": run.cuts, "cutflows": {val: cutflow.tolist() for val, cutflow in run.cutflows.items()}})
+    logging.info(f'histograms saved as {artifact}')
+    cutflow = os.path.splitext(plot_name)[0] + '.cutflow.csv'
+    selection.write_cutflow(os.path.join(output_dir, cutflow), run.cuts, run.cutflows)
+    logging.info(f'cutflow saved as {cutflow}')
+    return plot_name
+    
+if __name__ == '__main__':
+    metrics.start('collector')
+
+    # Establish a connection to RabbitMQ
+    connection = broker.connect_to_rabbitmq()
+    channel = connection.channel()
+
+    # Declare the queues to consume from, the per-run queues are added as runs are announced
+    channel.queue_declare(queue='runs_queue', durable=True)
+    channel.queue_declare(queue='shutdown_queue', durable=True)
+
+
+    # Start consuming messages from RabbitMQ
+    channel.basic_consume(queue='runs_queue', on_message_callback=capture.recorded('runs_queue', callback_run), auto_ack=True)
+    resume_runs()
+    if checkpoint_interval:
+        connection.call_later(checkpoint_interval, checkpoint)
+    if progress_interval:
+        connection.call_later(progress_interval, report_progress)
+    metrics.watch_queues(connection, channel, lambda: ['runs_queue'] + [broker.run_queue(name, run_id) for run_id in runs for name in broker.run_queues])
+    logging.info(f"Collector is listening for runs on 'runs_queue'...")
+    channel.start_consuming()
@@ -1,15 +1,17 @@
-import infofile
-import pika
 import time
 import logging
 import json
+import signal
 import awkward as ak
-import vector
-import sys
 import os
-
-MeV = 0.001
-GeV = 1.0
+import analysis
+import broker
+import capture
+import histograms
+import metrics
+import profiling
+import selection
+from collections import defaultdict
 
 debug = os.getenv('DEBUG', 'False').lower() == 'true'
 if debug:
@@ -17,176 +19,238 @@ if debug:
 else:
     logging.basicConfig(level=logging.WARNING, handlers=[logging.StreamHandler()])
 
-lumi = 10.0 # 10.0 used for final analysis
-
-variables = ['lep_pt','lep_eta','lep_phi','lep_E','lep_charge','lep_type']
-weight_variables = ["mcWeight", "scaleFactor_PILEUP", "scaleFactor_ELE", "scaleFactor_MUON", "scaleFactor_LepTRIGGER"]
-
-samples = {
-
-    'data': {
-        'list' : ['data_A','data_B','data_C','data_D'], # data is from 2016, first four periods of data taking (ABCD)
-    },
-
-    r'Background $Z,t\bar{t}$' : { # Z + ttbar
-        'list' : ['Zee','Zmumu','ttbar_lep'],
-        'color' : "#6b59d3" # purple
-    },
-
-    r'Background $ZZ^*$' : { # ZZ
-        'list' : ['llll'],
-        'color' : "#ff0000" # red
-    },
-
-    r'Signal ($m_H$ = 125 GeV)' : { # H -> ZZ -> llll
-        'list' : ['ggH125_ZZ4lep','VBFH125_ZZ4lep','WH125_ZZ4lep','ZH125_ZZ4lep'],
-        'color' : "#00cdff" # light blue
-    },
-
-}
-
-# Cut lepton type (electron type is 11,  muon type is 13)
-def cut_lep_type(lep_type):
-    sum_lep_type = lep_type[:, 0] + lep_type[:, 1] + lep_type[:, 2] + lep_type[:, 3]
-    lep_type_cut_bool = (sum_lep_type != 44) & (sum_lep_type != 48) & (sum_lep_type != 52)
-    return lep_type_cut_bool # True means we should remove this entry (lepton type does not match)
-
-# Cut lepton charge
-def cut_lep_charge(lep_charge):
-    # first lepton in each event is [:, 0], 2nd lepton is [:, 1] etc
-    sum_lep_charge = lep_charge[:, 0] + lep_charge[:, 1] + lep_charge[:, 2] + lep_charge[:, 3] != 0
-    return sum_lep_charge # True means we should remove this entry (sum of lepton charges is not equal to 0)
-
-# Calculate invariant mass of the 4-lepton state
-# [:, i] selects the i-th lepton in each event
-def calc_mass(lep_pt, lep_eta, lep_phi, lep_E):
-    p4 = vector.zip({"pt": lep_pt, "eta": lep_eta, "phi": lep_phi, "E": lep_E})
-    invariant_mass = (p4[:, 0] + p4[:, 1] + p4[:, 2] + p4[:, 3]).M * MeV # .M calculates the invariant mass
-    return invariant_mass
-
-def calc_weight(weight_variables, sample, events):
-    info = infofile.infos[sample]
-    xsec_weight = (lumi*1000*info["xsec"])/(info["sumw"]*info["red_eff"]) #*1000 to go from fb-1 to pb-1
-    total_weight = xsec_weight 
-    for variable in weight_variables:
-        total_weight = total_weight * events[variable]
-    return total_weight
-
-def process_sample(data, step_size = 1000000):
-    # Define empty list to hold all data for this sample
-    sample_data = []
-    # Perform the cuts for each data entry in the tree
-    # We can use data[~boolean] to remove entries from the data set
-
-    data['leading_lep_pt'] = data['lep_pt'][:,0]
-    data['sub_leading_lep_pt'] = data['lep_pt'][:,1]
-    data['third_leading_lep_pt'] = data['lep_pt'][:,2]
-    data['last_lep_pt'] = data['lep_pt'][:,3]
-    
-    lep_type = data['lep_type']
-    data = data[~cut_lep_type(lep_type)]
-    lep_charge = data['lep_charge']
-    data = data[~cut_lep_charge(lep_charge)]
-
-    data['mass'] = calc_mass(data['lep_pt'], data['lep_eta'], data['lep_phi'], data['lep_E'])
-
-    # Append data to the whole sample data list
-    sample_data.append(data)
-
-    return ak.concatenate(sample_data)
-
-def mc_process_sample(data, value, step_size = 1000000):
-    sample_data = []
-
-    data['leading_lep_pt'] = data['lep_pt'][:,0]
-    data['sub_leading_lep_pt'] = data['lep_pt'][:,1]
-    data['third_leading_lep_pt'] = data['lep_pt'][:,2]
-    data['last_lep_pt'] = data['lep_pt'][:,3]
-    
-        # Cuts
-    lep_type = data['lep_type']
-    data = data[~cut_lep_type(lep_type)]
-    lep_charge = data['lep_charge']
-    data = data[~cut_lep_charge(lep_charge)]
-        
-        # Invariant Mass
-    data['mass'] = calc_mass(data['lep_pt'], data['lep_eta'], data['lep_phi'], data['lep_E'])
-
-        # Store Monte Carlo weights in the data
-    data['totalWeight'] = calc_weight(weight_variables, value, data)
-
-        # Append data to the whole sample data list
-    sample_data.append(data)
-
-    # turns sample_data back into an awkward array
-    return ak.concatenate(sample_data)
-
+# Each consumer adds the histograms of every work unit it processes into partial histograms per
+# run and sample, and sends them, with the ids of the units they contain, once AGGREGATE_UNITS units
+# have been added or AGGREGATE_SECONDS after the first one, or when no task has arrived for
+# AGGREGATE_IDLE_MS, as happens at the end of a run. The collector then merges a message per
+# consumer and flush rather than one per chunk. Tasks are only acknowledged once the partial
+# histograms holding their units have been published, so the tasks of a consumer that dies before
+# flushing go back to the queue. The broker stops delivering once the prefetch count of tasks is
+# unacknowledged, so the partials are flushed when that many have been added. Tasks wait in memory
+# until they are processed, so the prefetch count is AGGREGATE_TASKS but no more than TASK_BUFFER_MB
+# of the largest tasks (MAX_MESSAGE_MB) hold, 2 by default, which also leaves queued tasks to the
+# other consumers rather than a few taking them all.
+aggregate_units = int(os.getenv('AGGREGATE_UNITS', 50))
+aggregate_tasks = int(os.getenv('AGGREGATE_TASKS', 8))
+aggregate_seconds = float(os.getenv('AGGREGATE_SECONDS', 5))
+aggregate_idle = float(os.getenv('AGGREGATE_IDLE_MS', 200)) / 1000
+max_message_bytes = float(os.getenv('MAX_MESSAGE_MB', 16)) * 1024**2
+task_buffer_bytes = float(os.getenv('TASK_BUFFER_MB', 32)) * 1024**2
+prefetch = max(1, min(aggregate_tasks, int(task_buffer_bytes // max_message_bytes)))
+
+# The units of a task are decoded and processed one at a time, each in sub-batches of whole events
+# holding about SUB_BATCH_MB of encoded data (0 takes a unit at once), so the arrays built while
+# processing stay the same size however large the tasks are. The histograms of the sub-batches of
+# a unit are added up and the unit is aggregated as a whole. The cutflow of every unit, the events
+# and sum of weights left after each cut, is counted from the same selection pass and aggregated
+# with the histograms.
+sub_batch_bytes = int(float(os.getenv('SUB_BATCH_MB', 4)) * 1024**2)
+
+partials = defaultdict(dict) # (result queue, run id) -> sample -> partial result
+partial_units = 0
+unacked = [] # delivery tags of the tasks whose units are in the partials
+first_unit_time = None
+idle_timer = None
+
+def aggregate(queue, run_id, unit, hist, num_events, cutflow, filled=None):
+    global partial_units, first_unit_time
+    partial = partials[(queue, run_id)].setdefault(unit["val"], {
+        "identifier": unit["identifier"], "val": unit["val"], "units": [], "events": 0,
+        "hist": histograms.empty(), "variations": {}, "cutflow": 0})
+    if unit["unit"] in partial["units"]:
+        # A unit sent again can reach the consumer still holding its first copy
+        return
+    partial["units"].append(unit["unit"])
+    partial["events"] += num_events
+    partial["hist"] += hist
+    partial["cutflow"] = partial["cutflow"] + cutflow
+    for name, varied in (filled or {}).items():
+        if name in partial["variations"]:
+            partial["variations"][name] += varied
+        else:
+            partial["variations"][name] = varied
+    partial_units += 1
+    if first_unit_time is None:
+        first_unit_time = time.time()
+
+class Lines:
+    """Part of a unit's text read as a file, so ak.from_json parses it without a copy of the whole part."""
+    def __init__(self, data, start, stop):
+        self.data = data
+        self.position = start
+        self.stop = stop
+
+    def read(self, size=-1):
+        end = self.stop if size < 0 else min(self.position + size, self.stop)
+        piece = self.data[self.position:end].encode()
+        self.position = end
+        return piece
+
+def sub_batches(data):
+    """Decode the line delimited events of a work unit a sub-batch at a time, in the analysis dtypes."""
+    if not sub_batch_bytes:
+        yield analysis.with_dtypes(ak.from_json(data, line_delimited=True))
+        return
+    start = 0
+    while start < len(data):
+        # Up to the end of the line sub_batch_bytes further on, or the end of the unit
+        stop = data.find('\n', start + sub_batch_bytes) + 1 or len(data)
+        # JSON numbers decode as float64 and int64, which only live until the cast
+        yield analysis.with_dtypes(ak.from_json(Lines(data, start, stop), line_delimited=True))
+        start = stop
+
+def after_task():
+    global idle_timer
+    if idle_timer is not None:
+        connection.remove_timeout(idle_timer)
+        idle_timer = None
+    if (partial_units >= aggregate_units or len(unacked) >= prefetch
+            or time.time() - first_unit_time >= aggregate_seconds):
+        flush_partials()
+    elif partial_units:
+        idle_timer = connection.call_later(aggregate_idle, on_idle)
+
+def on_idle():
+    global idle_timer
+    idle_timer = None
+    flush_partials()
+
+def flush_partials():
+    """Send the partial histograms of every run and sample, acknowledge their tasks and start new ones."""
+    global partial_units, first_unit_time
+    for (queue, run_id), by_sample in partials.items():
+        with metrics.timed('encode'):
+            results = [dict(partial, hist=histograms.encode(partial["hist"]), cutflow=partial["cutflow"].tolist(),
+                            variations={name: histograms.encode(varied) for name, varied in partial["variations"].items()})
+                       for partial in by_sample.values()]
+            payload = json.dumps({"results": results, "run_id": run_id})
+        with metrics.timed('publish'):
+            channel.basic_publish(exchange='', routing_key=broker.run_queue(queue, run_id), body=payload)
+        metrics.count(queue, payload, sum(partial["events"] for partial in by_sample.values()), 'out')
+    if unacked:
+        # Delivery tags grow on a channel, so this acknowledges every task added since the last flush
+        channel.basic_ack(delivery_tag=max(unacked), multiple=True)
+    if partial_units:
+        logging.info(f"partial histograms of {partial_units} units sent")
+    partials.clear()
+    unacked.clear()
+    partial_units = 0
+    first_unit_time = None
+
+def process_task(ch, method, body, queue, result_queue, process_unit):
+    """Process every unit of a task with process_unit and add them to the partials, or if any fails
+    drop the task and report it, so a task that cannot be processed does not take down every
+    consumer in turn and its run fails instead of waiting for it."""
+    metrics.in_flight.labels(metrics.role).inc()
+    message = None
+    try:
+        with metrics.timed('decode'):
+            message = json.loads(body)
+        # A task packs one or more work units, only added once all of them are processed
+        results = [process_unit(message, unit) for unit in message["units"]]
+    except Exception as e:
+        logging.exception(f"Dropping a task from {queue} that could not be processed")
+        if isinstance(message, dict) and "run_id" in message:
+            report_failure(ch, message, f"{type(e).__name__}: {e}")
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        return
+    finally:
+        metrics.in_flight.labels(metrics.role).dec()
+    for unit, num_events, result in results:
+        aggregate(result_queue, message["run_id"], unit, *result)
+    metrics.count(queue, body, sum(num_events for _, num_events, _ in results))
+
+    unacked.append(method.delivery_tag)
+    after_task()
+
+def report_failure(ch, message, error):
+    # On the run's control queue, so the collector fails the run and tells whoever submitted it
+    units = [unit.get("unit") for unit in message.get("units", []) if isinstance(unit, dict)]
+    ch.basic_publish(exchange='', routing_key=broker.run_queue('control_queue', message["run_id"]),
+                     body=json.dumps({"run_id": message["run_id"], "type": "failed", "units": units, "error": error}))
+
+def process_unit(message, unit):
+    hist = histograms.empty()
+    cutflow = selection.empty_cutflow(message.get("cuts"))
+    num_events = selected = 0
+    for events in sub_batches(unit.pop("data")):
+        num_events += len(events)
+        with metrics.timed('process'):
+            data = analysis.process_sample(events, message.get("cuts"), cutflow=cutflow)
+            hist += histograms.fill(ak.to_numpy(data['mass']))
+        selected += len(data)
+        del events, data # before the next sub-batch is decoded
+    return unit, num_events, (hist, selected, cutflow)
+
+def mc_process_unit(message, unit):
+    val = unit["val"]
+    lumi = message["lumi"]
+    hist = histograms.empty()
+    filled = {}
+    cutflow = selection.empty_cutflow(message.get("cuts"))
+    num_events = selected = 0
+    for events in sub_batches(unit.pop("data")):
+        num_events += len(events)
+        with metrics.timed('process'):
+            data = analysis.mc_process_sample(events, val, lumi, message.get("cuts"), cutflow=cutflow)
+            for name, varied in analysis.fill_variations(data, val, lumi).items():
+                filled[name] = filled[name] + varied if name in filled else varied
+            hist += histograms.fill(ak.to_numpy(data['mass']), ak.to_numpy(data['totalWeight']))
+        selected += len(data)
+        del events, data
+    return unit, num_events, (hist, selected, cutflow, filled)
+
+@profiling.profiled('consumer.callback')
 def callback(ch, method, properties, body):
-    message = json.loads(body)
-    incoming = ak.from_json(message["data"])
-    identifier = message["identifier"]
-    val = message["val"]
     logging.info("received")
+    process_task(ch, method, body, 'task_queue', 'result_queue', process_unit)
 
-    data = process_sample(incoming)
-
-    payload = json.dumps({"data": ak.to_json(data), "identifier": identifier})
-
-    channel.basic_publish(exchange='', routing_key='result_queue',body=payload)
-    logging.info("data sent")
-
+@profiling.profiled('consumer.mc_callback')
 def mc_callback(ch, method, properties, body):
-    message = json.loads(body)
-    incoming = ak.from_json(message["data"])
-    identifier = message["identifier"]
-    val = message["val"]
     logging.info("mc recieved")
-    info = infofile.infos[val]
-    xsec_weight = (lumi*1000*info["xsec"])/(info["red_eff"]*info["sumw"]) #*1000 to go from fb-1 to pb-1
-
-    data = mc_process_sample(incoming, val)
-
-    payload = json.dumps({"data": ak.to_json(data), "identifier": identifier})
-    
-    channel.basic_publish(exchange='', routing_key='mc_result_queue',body=payload)
-    logging.info("mc data sent")
+    process_task(ch, method, body, 'mc_task_queue', 'mc_result_queue', mc_process_unit)
 
 def callback_shutdown(ch, method, properties, body):
     incoming = ak.from_json(body)
     logging.info("recieved shutdown command")
-    ch.stop_consuming()
+    shut_down()
+
+def shut_down():
+    flush_partials()
+    channel.stop_consuming()
     connection.close()
 
-def connect_to_rabbitmq():
-    while True:
-        try:
-            logging.info("Attempting to connect to RabbitMQ...")
-            connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
-            return connection
-        except pika.exceptions.AMQPConnectionError:
-            logging.info("Failed to connect to RabbitMQ. Retrying in 5 seconds...")
-            time.sleep(10)
-    
-# Wait for a successful connection
-connection = connect_to_rabbitmq()
-
-# Create a channel
-channel = connection.channel()
-channel.basic_qos(prefetch_count=1)
-
-# Declare queues
-channel.queue_declare(queue='task_queue', durable=True)
-channel.queue_declare(queue='result_queue', durable=True)
-channel.queue_declare(queue='shutdown_queue', durable=True)
-channel.queue_declare(queue='mc_task_queue', durable=True)
-channel.queue_declare(queue='mc_result_queue', durable=True)
-
-
-# Set up the consumer to consume messages from the queue
-channel.basic_consume(queue='shutdown_queue', on_message_callback=callback_shutdown, auto_ack=True)
-
-channel.basic_consume(queue='task_queue', on_message_callback=callback, auto_ack=True)
-channel.basic_consume(queue='mc_task_queue', on_message_callback=mc_callback, auto_ack=True)
-
-logging.info(' [*] Waiting for messages. To exit press CTRL+C')
-channel.start_consuming()
+def on_sigterm(signum, frame):
+    # Stopped or scaled down: send the partials and acknowledge their tasks once the current task is done
+    logging.info("received SIGTERM")
+    connection.add_callback_threadsafe(shut_down)
+
+if __name__ == '__main__':
+    metrics.start('consumer')
+
+    # Wait for a successful connection
+    connection = broker.connect_to_rabbitmq()
+
+    # Create a channel
+    channel = connection.channel()
+    # No more tasks across both task queues than the task buffer holds
+    channel.basic_qos(prefetch_count=prefetch, global_qos=True)
+
+    # Declare queues
+    channel.queue_declare(queue='task_queue', durable=True)
+    channel.queue_declare(queue='shutdown_queue', durable=True)
+    channel.queue_declare(queue='mc_task_queue', durable=True)
+
+
+    # Set up the consumer to consume messages from the queue
+    channel.basic_consume(queue='shutdown_queue', on_message_callback=callback_shutdown, auto_ack=True)
+
+    # Tasks are acknowledged manually once the partial histograms holding their units are sent
+    channel.basic_consume(queue='task_queue', on_message_callback=capture.recorded('task_queue', callback))
+    channel.basic_consume(queue='mc_task_queue', on_message_callback=capture.recorded('mc_task_queue', mc_callback))
+
+    metrics.watch_queues(connection, channel, lambda: ['task_queue', 'mc_task_queue'])
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    logging.info(' [*] Waiting for messages. To exit press CTRL+C')
+    channel.start_consuming()
@@ -0,0 +1,132 @@
+"""Run the analysis on dask instead of the RabbitMQ pipeline
+
+Every chunk is read and analysed by a dask task calling the same functions as the consumers, and the
+per-chunk histograms are merged pairwise in a tree, so no single task adds up every chunk. Uses a
+LocalCluster of --workers processes unless --scheduler gives the address of a running cluster.
+"""
+import argparse
+import functools
+import json
+import logging
+import os
+import time
+import uuid
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from dask.distributed import Client, LocalCluster
+import analysis
+import histograms
+import infofile
+import plotting
+import producer
+import remote
+import selection
+
+parser = argparse.ArgumentParser(description="Run the analysis on a dask cluster and save its plot")
+parser.add_argument('href', nargs='?', default=os.getenv('HREF'), help="where the Data/ and MC/ folders are, defaults to HREF")
+parser.add_argument('--lumi', type=float, default=float(os.getenv('LUMI', 10.0)))
+parser.add_argument('--samples', default=os.getenv('SAMPLES', ''), help="comma separated sample names, every sample if not given")
+parser.add_argument('--cuts', type=json.loads, default=json.loads(os.getenv('CUTS') or 'null'), help="selection as JSON, the default cuts if not given")
+parser.add_argument('--workers', type=int, default=producer.consumers, help="processes of the local cluster")
+parser.add_argument('--scheduler', default=os.getenv('DASK_SCHEDULER'), help="address of an existing dask scheduler")
+parser.add_argument('--split-every', type=int, default=8, help="histograms merged by each task of the tree reduction")
+parser.add_argument('--run-id', default=os.getenv('RUN_ID'))
+args = parser.parse_args()
+
+debug = os.getenv('DEBUG', 'False').lower() == 'true'
+logging.basicConfig(level=logging.INFO if debug else logging.WARNING, handlers=[logging.StreamHandler()])
+
+plot_binning = (float(os.getenv('PLOT_XMIN', 80)), float(os.getenv('PLOT_XMAX', 250)), float(os.getenv('PLOT_STEP', 5)))
+output_dir = os.getenv('OUTPUT_DIR', '/app/logs')
+
+def file_path(href, val, useweight):
+    if useweight:
+        return href + "MC/mc_" + str(infofile.infos[val]["DSID"]) + "." + val + ".4lep.root:mini;1"
+    return href + "Data/" + val + ".4lep.root:mini;1"
+
+@functools.lru_cache(maxsize=16)
+def open_tree(path):
+    # Kept open per worker process, so the chunks of a file share one file handle
+    return remote.open_file(path)
+
+def process_chunk(href, s, val, useweight, entry_start, entry_stop, lumi, cuts):
+    """Histograms and cutflow of one chunk, the same work a consumer does for one work unit."""
+    events = analysis.with_dtypes(open_tree(file_path(href, val, useweight)).arrays(
+        producer.branches(useweight), library="ak", entry_start=entry_start, entry_stop=entry_stop))
+    cutflow = selection.empty_cutflow(cuts)
+    if useweight:
+        data = analysis.mc_process_sample(events, val, lumi, cuts, cutflow=cutflow)
+        hist = histograms.fill(data['mass'].to_numpy(), data['totalWeight'].to_numpy())
+        filled = analysis.fill_variations(data, val, lumi)
+    else:
+        data = analysis.process_sample(events, cuts, cutflow=cutflow)
+        hist = histograms.fill(data['mass'].to_numpy())
+        filled = {}
+    return {"hists": {val: hist}, "groups": {val: s}, "variations": {val: filled}, "cutflows": {val: cutflow},
+            "units": 1, "events": len(data)}
+
+def merge(*parts):
+    """Add up the histograms of several partial results."""
+    merged = {"hists": {}, "groups": {}, "variations": {}, "cutflows": {}, "units": 0, "events": 0}
+    for part in parts:
+        for val, hist in part["hists"].items():
+            merged["hists"][val] = merged["hists"][val] + hist if val in merged["hists"] else hist
+        for val, cutflow in part["cutflows"].items():
+            merged["cutflows"][val] = merged["cutflows"][val] + cutflow if val in merged["cutflows"] else cutflow
+        merged["groups"].update(part["groups"])
+        for val, filled in part["variations"].items():
+            target = merged["variations"].setdefault(val, {})
+            for name, hist in filled.items():
+                target[name] = target[name] + hist if name in target else hist
+        merged["units"] += part["units"]
+        merged["events"] += part["events"]
+    return merged
+
+def plan_chunks(href, selected):
+    # The producer's memory based chunk size, so both executors split the files the same way
+    producer.path = href
+    chunks = []
+    for s in producer.samples:
+        for val in producer.samples[s]['list']:
+            if selected and val not in selected:
+                continue
+            useweight = s != 'data'
+            tree = producer.get_MC_tree(val) if useweight else producer.get_tree(val)
+            chunk_size = producer.entries_per_chunk(tree, useweight)
+            for entry_start in range(0, tree.num_entries, chunk_size):
+                chunks.append((s, val, useweight, entry_start, min(entry_start + chunk_size, tree.num_entries)))
+    return chunks
+
+if __name__ == '__main__':
+    selection.check(args.cuts or selection.cuts, producer.branches(False), analysis.derived)
+    run_id = args.run_id or uuid.uuid4().hex[:8]
+    start_time = time.time()
+    if args.scheduler:
+        client = Client(args.scheduler)
+    else:
+        client = Client(LocalCluster(n_workers=args.workers, threads_per_worker=1))
+    logging.info(f"Dask dashboard at {client.dashboard_link}")
+
+    chunks = plan_chunks(args.href, [name for name in args.samples.split(',') if name])
+    futures = [client.submit(process_chunk, args.href, s, val, useweight, entry_start, entry_stop, args.lumi, args.cuts, pure=False)
+               for s, val, useweight, entry_start, entry_stop in chunks]
+    # Tree reduction, each level merging split_every results of the level below
+    while len(futures) > 1:
+        futures = [client.submit(merge, *futures[i:i + args.split_every]) for i in range(0, len(futures), args.split_every)]
+    result = futures[0].result() if futures else merge()
+    client.close()
+
+    plotting.plot_samples(result["hists"], result["groups"], result["variations"], producer.samples, args.lumi, plot_binning)
+    name = time.strftime("%d-%m-%Y %H-%M", time.localtime()) + f" {run_id}"
+    os.makedirs(output_dir, exist_ok=True)
+    plt.savefig(os.path.join(output_dir, f"{name}.png"))
+    plt.close()
+    plotting.save_artifact(os.path.join(output_dir, f"{name}.npz"), result["hists"], result["groups"], result["variations"],
+                           producer.samples, args.lumi, plot_binning,
+                           {"run_id": run_id, "start_time": start_time, "end_time": time.time(), "units": result["units"],
+                            "cuts": list(args.cuts or selection.cuts),
+                            "cutflows": {val: cutflow.tolist() for val, cutflow in result["cutflows"].items()}})
+    selection.write_cutflow(os.path.join(output_dir, f"{name}.cutflow.csv"), args.cuts or selection.cuts, result["cutflows"])
+    elapsed = time.time() - start_time
+    print(f"Run {run_id}: {result['units']} chunks, {result['events']} selected events in {elapsed:.1f} s, plot saved as {name}.png")
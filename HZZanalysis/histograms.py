@@ -0,0 +1,126 @@
+"""Fine-binned mass histograms that are accumulated during a run and rebinned when plotting
+
+A histogram is a (2, bins) array holding the sum of weights and the sum of squared weights in each
+bin of the base binning, so histograms from different chunks merge by adding them. As the base
+binning is uniform, the bin of every value is worked out once by arithmetic and the sums are
+filled with np.bincount, for one histogram or for many categories (weight variations) at once.
+"""
+import base64
+import numpy as np
+
+GeV = 1.0
+
+base_min, base_max = 0 * GeV, 1000 * GeV
+base_step = 0.5 * GeV
+base_edges = np.linspace(base_min, base_max, int(round((base_max - base_min) / base_step)) + 1)
+num_bins = len(base_edges) - 1
+index_dtype = np.dtype('<u2') if num_bins <= 2**16 else np.dtype('<u4')
+norm = num_bins / (base_max - base_min)
+# From 0 with a power of two bins per GeV, (value - base_min) * norm is exact and truncating it is the bin
+exact = base_min == 0 and np.log2(norm).is_integer()
+block_size = 65536 # values binned at a time, so the temporaries stay in cache
+
+def empty():
+    return np.zeros((2, num_bins))
+
+def bin_index(values):
+    """Base bin of each value inside the base range, binned as np.histogram does, and which values
+    those are (None when every value is inside)."""
+    inside = (values >= base_min) & (values <= base_max) # also drops NaN
+    if inside.all():
+        inside = None
+    else:
+        values = values[inside]
+    index = ((values - base_min) * norm).astype(np.intp)
+    np.minimum(index, num_bins - 1, out=index) # the upper edge belongs to the last bin
+    if not exact:
+        # Rounding can put a value one bin off its edges, so compare with them as np.histogram does
+        index -= values < base_edges[index]
+        index += (values >= base_edges[index + 1]) & (index != num_bins - 1)
+    return index, inside
+
+def fill(values, weights=None):
+    """Sum of weights and sum of squared weights in each base bin, unit weights if none are given."""
+    values = np.asarray(values, dtype=float)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+    hist = empty()
+    for start in range(0, len(values), block_size):
+        index, inside = bin_index(values[start:start + block_size])
+        if weights is None:
+            hist[0] += np.bincount(index, minlength=num_bins)
+            continue
+        w = weights[start:start + block_size]
+        if inside is not None:
+            w = w[inside]
+        # Both sums from the one bin lookup
+        hist[0] += np.bincount(index, w, num_bins)
+        hist[1] += np.bincount(index, w * w, num_bins)
+    if weights is None:
+        hist[1] = hist[0]
+    return hist
+
+def fill_categories(values, weights):
+    """A histogram for each name -> weights of weights, from one bin lookup for every category."""
+    values = np.asarray(values, dtype=float)
+    names = list(weights)
+    stacked = np.stack([np.asarray(weights[name], dtype=float) for name in names]) if names else np.zeros((0, len(values)))
+    # Category c, bin b is bin c * num_bins + b of a single long histogram
+    offsets = np.arange(len(names))[:, None] * num_bins
+    size = len(names) * num_bins
+    sumw = np.zeros(size)
+    sumw2 = np.zeros(size)
+    for start in range(0, len(values), block_size):
+        index, inside = bin_index(values[start:start + block_size])
+        w = stacked[:, start:start + block_size]
+        if inside is not None:
+            w = w[:, inside]
+        flat = (offsets + index).ravel()
+        sumw += np.bincount(flat, w.ravel(), size)
+        sumw2 += np.bincount(flat, (w * w).ravel(), size)
+    sumw = sumw.reshape(len(names), num_bins)
+    sumw2 = sumw2.reshape(len(names), num_bins)
+    return {name: np.array([sumw[i], sumw2[i]]) for i, name in enumerate(names)}
+
+def rebin(hist, xmin, xmax, step_size):
+    """Bin edges and histogram for a coarser binning, which has to line up with the base bins."""
+    first = (xmin - base_min) / base_step
+    last = (xmax - base_min) / base_step
+    factor = step_size / base_step
+    if not all(np.isclose(x, round(x)) for x in (first, last, factor)) or first < 0 or last > num_bins:
+        raise ValueError(f"binning {xmin}-{xmax} in steps of {step_size} does not line up with the base binning")
+    first, last, factor = int(round(first)), int(round(last)), int(round(factor))
+    if (last - first) % factor:
+        raise ValueError(f"range {xmin}-{xmax} is not a whole number of {step_size} GeV bins")
+    edges = base_edges[first:last + 1:factor]
+    return edges, hist[:, first:last].reshape(2, -1, factor).sum(axis=2)
+
+def encode(hist):
+    """The non-empty bins as base64 of the bin count, whether sumw2 equals sumw, the bin indices, sumw and sumw2.
+
+    Most of the fine bins of a single chunk are empty, and unweighted (data) histograms leave out
+    sumw2 as it is the same as sumw.
+    """
+    index = np.flatnonzero((hist != 0).any(axis=0))
+    same = np.array_equal(hist[0, index], hist[1, index])
+    parts = [np.array([len(index), same], dtype='<u4').tobytes(), index.astype(index_dtype).tobytes(),
+             hist[0, index].astype('<f8').tobytes()]
+    if not same:
+        parts.append(hist[1, index].astype('<f8').tobytes())
+    return base64.b64encode(b''.join(parts)).decode('ascii')
+
+def decode(encoded):
+    hist = empty()
+    if isinstance(encoded, dict):
+        # Written by a collector from before the binary encoding, e.g. in a checkpoint
+        hist[0, encoded["index"]] = encoded["sumw"]
+        hist[1, encoded["index"]] = encoded["sumw2"]
+        return hist
+    raw = base64.b64decode(encoded)
+    count, same = np.frombuffer(raw, dtype='<u4', count=2)
+    offset = 8
+    index = np.frombuffer(raw, dtype=index_dtype, count=count, offset=offset)
+    offset += count * index_dtype.itemsize
+    hist[0, index] = np.frombuffer(raw, dtype='<f8', count=count, offset=offset)
+    hist[1, index] = hist[0, index] if same else np.frombuffer(raw, dtype='<f8', count=count, offset=offset + 8 * count)
+    return hist
@@ -0,0 +1,57 @@
+"""Prometheus metrics served over HTTP by the producer, consumers and collector"""
+import os
+import time
+import logging
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# process_resident_memory_bytes and the other process_* metrics come with prometheus_client
+chunks = Counter('hzz_chunks', 'Chunks handled', ['role', 'queue'])
+events = Counter('hzz_events', 'Events handled', ['role', 'queue'])
+message_bytes = Counter('hzz_message_bytes', 'Bytes of message bodies sent or received', ['role', 'queue', 'direction'])
+stage_seconds = Histogram('hzz_stage_seconds', 'Time spent in each processing stage', ['role', 'stage'],
+                          buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf')))
+in_flight = Gauge('hzz_in_flight_messages', 'Messages received and not yet fully handled', ['role'])
+queue_depth = Gauge('hzz_queue_depth', 'Messages waiting in a queue', ['queue'])
+planned_events = Gauge('hzz_planned_events', 'Events the producer will send for each sample of a run', ['run', 'sample'])
+processed_events = Gauge('hzz_processed_events', 'Events of each sample of a run the collector has added', ['run', 'sample'])
+eta_seconds = Gauge('hzz_eta_seconds', 'Estimated seconds until every event of a run is processed', ['run'])
+speculative = Counter('hzz_speculative_units', 'Work units sent again because they were taking too long', ['role'])
+
+role = 'unknown'
+
+def start(name):
+    """Serve the metrics of this role on METRICS_PORT (0 disables the endpoint)."""
+    global role
+    role = name
+    port = int(os.getenv('METRICS_PORT', 8000))
+    if port:
+        try:
+            start_http_server(port)
+            logging.info(f"Metrics served on port {port}")
+        except OSError as e:
+            logging.warning(f"Metrics endpoint not started on port {port}: {e}")
+
+@contextmanager
+def timed(stage):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.labels(role, stage).observe(time.perf_counter() - start_time)
+
+def count(queue, body, num_events, direction='in'):
+    chunks.labels(role, queue).inc()
+    events.labels(role, queue).inc(num_events)
+    message_bytes.labels(role, queue, direction).inc(len(body))
+
+def watch_queues(connection, channel, queues, interval=5):
+    """Refresh queue_depth for the queues returned by queues() every interval seconds.
+
+    Runs on the connection's own thread through call_later, as pika channels are not thread safe.
+    """
+    def refresh():
+        for queue in queues():
+            queue_depth.labels(queue).set(channel.queue_declare(queue=queue, passive=True).method.message_count)
+        connection.call_later(interval, refresh)
+    connection.call_later(interval, refresh)
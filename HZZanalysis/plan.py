@@ -0,0 +1,107 @@
+import argparse
+import logging
+import os
+from collections import defaultdict
+import awkward as ak
+import infofile
+import producer
+
+parser = argparse.ArgumentParser(description="Estimate the work units, messages, bytes and runtime of a run without starting it")
+parser.add_argument('--href', default=os.getenv('HREF'), help="where the Data/ and MC/ folders are, defaults to HREF")
+parser.add_argument('--samples', default='', help="comma separated sample names, every sample if not given")
+parser.add_argument('--consumers', type=int, default=producer.consumers)
+parser.add_argument('--events-per-second', type=float, default=50000,
+                    help="events one consumer gets through per second, e.g. rate(hzz_events_total) of a previous run divided by its consumers")
+parser.add_argument('--read-mb-per-second', type=float, default=20,
+                    help="compressed megabytes per second the producer reads from HREF")
+parser.add_argument('--sample-entries', type=int, default=1000,
+                    help="entries read from each file to measure the encoded size per entry, 0 estimates it from the uncompressed size")
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.WARNING, handlers=[logging.StreamHandler()])
+producer.path = args.href
+selected = [name for name in args.samples.split(',') if name]
+
+def encoded_bytes_per_entry(tree, useweight):
+    # JSON is what goes over the wire, so measure it on the first few entries
+    branch_names = producer.branches(useweight)
+    if args.sample_entries and tree.num_entries:
+        head = tree.arrays(branch_names, library="ak", entry_stop=min(args.sample_entries, tree.num_entries))
+        return len(ak.to_json(head, line_delimited=True)) / len(head)
+    return sum(tree[branch].uncompressed_bytes for branch in branch_names) / max(tree.num_entries, 1)
+
+def split_count(size):
+    # The producer halves a message until it is under MAX_MESSAGE_MB
+    pieces = 1
+    while size / pieces > producer.max_message_bytes:
+        pieces *= 2
+    return pieces
+
+def plan_sample(val, useweight):
+    tree = producer.get_MC_tree(val) if useweight else producer.get_tree(val)
+    branch_names = producer.branches(useweight)
+    entries = tree.num_entries
+    chunk_size = producer.entries_per_chunk(tree, useweight)
+    entry_bytes = encoded_bytes_per_entry(tree, useweight)
+    # Whole chunks plus the remainder, each a work unit unless its message has to be split
+    sizes = [min(chunk_size, entries - start) * entry_bytes for start in range(0, entries, chunk_size)]
+    units = sum(split_count(size) for size in sizes)
+    # and the size of every unit as sent, after splitting
+    unit_bytes = [size / split_count(size) for size in sizes for _ in range(split_count(size))]
+    return {
+        "sample": val,
+        "entries": entries,
+        "infofile_events": infofile.infos[val]["events"] if val in infofile.infos else None,
+        "baskets": sum(tree[branch].num_baskets for branch in branch_names),
+        "compressed": sum(tree[branch].compressed_bytes for branch in branch_names),
+        "uncompressed": sum(tree[branch].uncompressed_bytes for branch in branch_names),
+        "entries_per_unit": chunk_size,
+        "units": units,
+        "unit_bytes": unit_bytes,
+        "message_bytes": entries * entry_bytes,
+    }
+
+def count_tasks(unit_bytes):
+    # The same packing the producer does, over every unit going to one task queue
+    tasks = 0
+    pending = 0
+    for size in unit_bytes:
+        if pending and pending + size > producer.max_message_bytes:
+            tasks += 1
+            pending = 0
+        pending += size
+        if pending >= producer.pack_bytes:
+            tasks += 1
+            pending = 0
+    return tasks + (pending > 0)
+
+rows = []
+# The producer packs the units of every data sample into task_queue and of every Monte Carlo sample into mc_task_queue
+queue_units = defaultdict(list)
+for s in producer.samples:
+    for val in producer.samples[s]['list']:
+        if selected and val not in selected:
+            continue
+        row = plan_sample(val, useweight=(s != 'data'))
+        rows.append(row)
+        queue_units['task_queue' if s == 'data' else 'mc_task_queue'] += row["unit_bytes"]
+tasks = sum(count_tasks(unit_bytes) for unit_bytes in queue_units.values())
+
+MB = 1024**2
+print(f"{'sample':<16}{'entries':>10}{'infofile':>10}{'baskets':>9}{'comp MB':>9}{'uncomp MB':>10}{'per unit':>10}{'units':>7}{'sent MB':>9}{'process s':>10}")
+for row in rows:
+    process_seconds = row["entries"] / args.events_per_second
+    print(f"{row['sample']:<16}{row['entries']:>10}{row['infofile_events'] or '-':>10}{row['baskets']:>9}"
+          f"{row['compressed']/MB:>9.1f}{row['uncompressed']/MB:>10.1f}{row['entries_per_unit']:>10}{row['units']:>7}"
+          f"{row['message_bytes']/MB:>9.1f}{process_seconds:>10.1f}")
+
+entries = sum(row["entries"] for row in rows)
+read_seconds = sum(row["compressed"] for row in rows) / MB / args.read_mb_per_second
+process_seconds = entries / (args.events_per_second * args.consumers)
+# A consumer cannot finish before the largest unit it may be handed last
+tail_seconds = max((min(row["entries_per_unit"], row["entries"]) for row in rows), default=0) / args.events_per_second
+print()
+print(f"work units: {sum(row['units'] for row in rows)}, task messages: {tasks}, "
+      f"task bytes: {sum(row['message_bytes'] for row in rows)/MB:.1f} MB")
+print(f"reading: {read_seconds:.1f} s, processing on {args.consumers} consumers: {process_seconds:.1f} s")
+print(f"estimated runtime: {max(read_seconds, process_seconds) + tail_seconds:.1f} s")
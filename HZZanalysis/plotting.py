@@ -0,0 +1,187 @@
+"""The 4-lepton invariant mass plot, drawn straight from binned histograms
+
+Every histogram is a (2, bins) array of the sum of weights and the sum of squared weights, so
+drawing costs the same however many events went into it. The histograms of a run are saved with
+its plot as an artifact, from which replot.py draws the plot again without a broker or input files.
+"""
+import json
+import numpy as np
+import histograms
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.ticker import AutoMinorLocator # for minor ticks
+
+signal_sample = r'Signal ($m_H$ = 125 GeV)'
+
+def group_histograms(hists, groups, binning):
+    """Add up the fine histograms of the samples in each group and rebin them to (xmin, xmax, step)."""
+    grouped = {}
+    for val, hist in hists.items():
+        if groups[val] in grouped:
+            grouped[groups[val]] = grouped[groups[val]] + hist
+        else:
+            grouped[groups[val]] = hist
+    return {s: histograms.rebin(hist, *binning)[1] for s, hist in grouped.items()}
+
+def systematic_band(variations, groups, backgrounds, nominal, binning):
+    """Upward and downward shifts of the background stack, adding each variation's shift in quadrature."""
+    names = {name for val in variations for name in variations[val]}
+    if not names:
+        return None, None
+    up = np.zeros(len(nominal))
+    down = np.zeros(len(nominal))
+    for name in names:
+        varied = group_histograms({val: variations[val][name] for val in variations if name in variations[val]}, groups, binning)
+        shift = sum(varied[s][0] for s in backgrounds if s in varied) - nominal
+        up += np.maximum(shift, 0)**2
+        down += np.minimum(shift, 0)**2
+    return np.sqrt(up), np.sqrt(down)
+
+def plot_samples(hists, groups, variations, samples, lumi, binning):
+    """Plot fine histograms per sample, grouped and coloured as in the samples dictionary."""
+    edges = histograms.rebin(histograms.empty(), *binning)[0]
+    grouped = group_histograms(hists, groups, binning)
+
+    # backgrounds in the order of the samples dictionary, bottom of the stack first
+    backgrounds = [(s, samples[s]['color'], grouped[s]) for s in samples if s not in ['data', signal_sample] and s in grouped]
+    nominal = sum((hist[0] for _, _, hist in backgrounds), np.zeros(len(edges) - 1))
+    syst_up, syst_down = systematic_band(variations, groups, [s for s, _, _ in backgrounds], nominal, binning)
+
+    return plot_mass(edges, grouped.get('data'), backgrounds,
+                     signal=(signal_sample, samples[signal_sample]['color'], grouped[signal_sample]) if signal_sample in grouped else None,
+                     syst=(syst_up, syst_down) if backgrounds and syst_up is not None else None,
+                     lumi=lumi)
+
+def save_artifact(path, hists, groups, variations, samples, lumi, binning, metadata=None):
+    """Write the fine histograms of a run and everything needed to plot them to an npz file."""
+    names = sorted(hists)
+    varied = sorted((val, name) for val in variations for name in variations[val])
+    info = {"samples": names, "variations": varied, "groups": {val: groups[val] for val in names},
+            "styles": samples, "lumi": lumi, "binning": list(binning), **(metadata or {})}
+    np.savez_compressed(path, edges=histograms.base_edges,
+                        hists=np.array([hists[val] for val in names]).reshape(len(names), 2, histograms.num_bins),
+                        variations=np.array([variations[val][name] for val, name in varied]).reshape(len(varied), 2, histograms.num_bins),
+                        info=np.array(json.dumps(info)))
+
+def load_artifact(path):
+    """The info (groups, styles, lumi, binning and run metadata), hists and variations written by save_artifact."""
+    with np.load(path) as artifact:
+        if not np.array_equal(artifact["edges"], histograms.base_edges):
+            raise ValueError(f"{path} was saved with a different base binning")
+        info = json.loads(str(artifact["info"]))
+        hists = dict(zip(info["samples"], artifact["hists"]))
+        variations = {}
+        for (val, name), hist in zip(info["variations"], artifact["variations"]):
+            variations.setdefault(val, {})[name] = hist
+    return info, hists, variations
+
+def plot_mass(edges, data, backgrounds, signal=None, syst=None, lumi=10.0):
+    """Draw data points over stacked backgrounds and the signal on top.
+
+    backgrounds is a list of (label, color, histogram) drawn bottom to top, signal a single
+    (label, color, histogram) and syst the (up, down) shifts of the background stack.
+    """
+    step_size = edges[1] - edges[0]
+    bin_centres = (edges[:-1] + edges[1:]) / 2
+    if data is None:
+        data = np.zeros((2, len(bin_centres)))
+
+    main_axes = plt.gca() # get current axes
+
+    # plot the data points
+    data_x = data[0]
+    data_x_errors = np.sqrt( data_x ) # statistical error on the data
+    main_axes.errorbar(x=bin_centres, y=data_x, yerr=data_x_errors,
+                        fmt='ko', # 'k' means black and 'o' is for circles
+                        label='Data')
+
+    # stack the Monte Carlo bars, each one starting where the previous one ends
+    mc_x_tot = np.zeros(len(bin_centres)) # stacked background MC y-axis value
+    mc_sumw2 = np.zeros(len(bin_centres))
+    for label, color, hist in backgrounds:
+        main_axes.stairs(mc_x_tot + hist[0], edges, baseline=mc_x_tot.copy(),
+                         fill=True, color=color, label=label)
+        mc_x_tot = mc_x_tot + hist[0]
+        mc_sumw2 = mc_sumw2 + hist[1]
+
+    if backgrounds:
+        # MC statistical uncertainty: sqrt(sum w^2)
+        mc_x_err = np.sqrt(mc_sumw2)
+        main_axes.bar(bin_centres, # x
+                        2*mc_x_err, # heights
+                        alpha=0.5, # half transparency
+                        bottom=mc_x_tot-mc_x_err, color='none',
+                        hatch="////", width=step_size, label='Stat. Unc.' )
+
+        # systematic uncertainty from the weight variations
+        if syst is not None:
+            syst_up, syst_down = syst
+            main_axes.bar(bin_centres, # x
+                            syst_up + syst_down, # heights
+                            alpha=0.5, # half transparency
+                            bottom=mc_x_tot-syst_down, color='none',
+                            hatch="\\\\", width=step_size, label='Syst. Unc.' )
+
+    # plot the signal bar on top of the backgrounds
+    if signal is not None:
+        label, color, hist = signal
+        main_axes.stairs(mc_x_tot + hist[0], edges, baseline=mc_x_tot,
+                         fill=True, color=color, label=label)
+
+    # set the x-limit of the main axes
+    main_axes.set_xlim( left=edges[0], right=edges[-1] )
+
+    # separation of x axis minor ticks
+    main_axes.xaxis.set_minor_locator( AutoMinorLocator() )
+
+    # set the axis tick parameters for the main axes
+    main_axes.tick_params(which='both', # ticks on both x and y axes
+                            direction='in', # Put ticks inside and outside the axes
+                            top=True, # draw ticks on the top axis
+                            right=True ) # draw ticks on right axis
+
+    # x-axis label
+    main_axes.set_xlabel(r'4-lepton invariant mass $\mathrm{m_{4l}}$ [GeV]',
+                        fontsize=13, x=1, horizontalalignment='right' )
+
+    # write y-axis label for main axes
+    main_axes.set_ylabel('Events / '+str(step_size)+' GeV',
+                            y=1, horizontalalignment='right')
+
+    # set y-axis limits for main axes
+    main_axes.set_ylim( bottom=0, top=max(np.amax(data_x), np.amax(mc_x_tot), 1)*1.6 )
+
+    # add minor ticks on y-axis for main axes
+    main_axes.yaxis.set_minor_locator( AutoMinorLocator() )
+
+    # Add text 'ATLAS Open Data' on plot
+    plt.text(0.05, # x
+                0.93, # y
+                'ATLAS Open Data', # text
+                transform=main_axes.transAxes, # coordinate system used is that of main_axes
+                fontsize=13 )
+
+    # Add text 'for education' on plot
+    plt.text(0.05, # x
+                0.88, # y
+                'for education', # text
+                transform=main_axes.transAxes, # coordinate system used is that of main_axes
+                style='italic',
+                fontsize=8 )
+
+    # Add energy and luminosity
+    plt.text(0.05, # x
+                0.82, # y
+                r'$\sqrt{s}$=13 TeV,$\int$L dt = '+str(lumi)+' fb$^{-1}$', # text
+                transform=main_axes.transAxes ) # coordinate system used is that of main_axes
+
+    # Add a label for the analysis carried out
+    plt.text(0.05, # x
+                0.76, # y
+                r'$H \rightarrow ZZ^* \rightarrow 4\ell$', # text
+                transform=main_axes.transAxes ) # coordinate system used is that of main_axes
+
+    # draw the legend
+    main_axes.legend( frameon=False ) # no box around the legend
+    return main_axes
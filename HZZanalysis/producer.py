@@ -3,7 +3,6 @@ import infofile # local file containing cross-sections, sums of weights, dataset
 import numpy as np # for numerical calculations such as histogramming
 import matplotlib.pyplot as plt # for plotting
 from matplotlib.ticker import AutoMinorLocator # for minor ticks
-import uproot # for reading .root files
 import awkward as ak # to represent nested data in columnar format
 import vector # for 4-momentum calculations
 import time
@@ -13,10 +12,37 @@ import json
 import sys
 import logging
 import os
-
-start_time = time.time()
+import uuid
+import multiprocessing
+from collections import defaultdict
+import broker
+import metrics
+import profiling
+import analysis
+import remote
+import selection
 
 consumers = int(os.getenv('NUM_CONSUMERS', 12))
+# In service mode the producer stays up and starts a run for every request on submit_queue
+service_mode = os.getenv('SERVICE_MODE', 'False').lower() == 'true'
+# Never keep more than this many tasks waiting in a shared task queue, so that several runs
+# topping the queues up at the same time get their work interleaved fairly
+max_queued = int(os.getenv('MAX_QUEUED', 2 * consumers))
+# Chunks are sized by how much branch data they hold rather than by a number of entries, and
+# any encoded message still larger than max_message_bytes is split in half until it fits
+chunk_bytes = float(os.getenv('CHUNK_MB', 4)) * 1024**2
+max_message_bytes = float(os.getenv('MAX_MESSAGE_MB', 16)) * 1024**2
+# Work units smaller than this (whole small samples, the tails of larger ones) are packed
+# together into one task until the task reaches this size, 0 sends every unit on its own
+pack_bytes = float(os.getenv('PACK_KB', 512)) * 1024
+# Once the task queues are empty, work units out for longer than SPECULATE_FACTOR times the
+# SPECULATE_PERCENTILE of the completed units' times (and at least SPECULATE_MIN_SECONDS) are sent
+# again once, and the collector keeps whichever result arrives first. SPECULATE_FACTOR=0 disables it.
+speculate_percentile = float(os.getenv('SPECULATE_PERCENTILE', 90))
+speculate_factor = float(os.getenv('SPECULATE_FACTOR', 2))
+speculate_min_seconds = float(os.getenv('SPECULATE_MIN_SECONDS', 10))
+speculate_interval = float(os.getenv('SPECULATE_INTERVAL', 5))
+speculate_min_completed = 5 # completed units needed before the percentile means anything
 debug = os.getenv('DEBUG', 'False').lower() == 'true'
 if debug:
     logging.basicConfig(level=logging.INFO, handlers=[logging.StreamHandler()])
@@ -26,8 +52,6 @@ else:
 MeV = 0.001
 GeV = 1.0
 
-path = sys.argv[1]
-
 
 samples = {
 
@@ -57,76 +81,284 @@ variables = ['lep_pt','lep_eta','lep_phi','lep_E','lep_charge','lep_type']
 
 def get_tree(sample_name):
     file_path = path + "Data/" + sample_name + ".4lep.root"
-    return  uproot.open(file_path + ":mini;1")
+    return remote.open_file(file_path + ":mini;1")
 
-def tree_chunks(tree, chunk_size, useweight):
+def branches(useweight):
     if useweight:
-        variable = variables + weight_variables
-    else:
-        variable = variables
-    for chunk in tree.iterate(variable, library="ak", step_size=chunk_size):
-        yield chunk
+        return variables + weight_variables
+    return variables
 
-def connect_to_rabbitmq():
+def entries_per_chunk(tree, useweight):
+    # Uncompressed bytes per entry summed over the branches read, so wide branches give smaller chunks
+    entry_bytes = sum(tree[branch].uncompressed_bytes for branch in branches(useweight)) / max(tree.num_entries, 1)
+    return max(1, int(chunk_bytes / max(entry_bytes, 1)))
+
+def tree_chunks(tree, chunk_size, useweight):
+    iterator = tree.iterate(branches(useweight), library="ak", step_size=chunk_size, report=True)
     while True:
-        try:
-            logging.info("Attempting to connect to RabbitMQ...")
-            connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
-            return connection
-        except pika.exceptions.AMQPConnectionError:
-            logging.info("Failed to connect to RabbitMQ. Retrying in 5 seconds...")
-            time.sleep(5)
+        with metrics.timed('read'):
+            chunk = next(iterator, None)
+        if chunk is None:
+            return
+        yield chunk
 
 def get_MC_tree(mc_name):
     background_Zee_path = path + "MC/mc_"+str(infofile.infos[mc_name]["DSID"])+"."+mc_name+".4lep.root"
-    return uproot.open(background_Zee_path + ":mini;1")
+    return remote.open_file(background_Zee_path + ":mini;1")
 
-def send_chunks(tree, destination, s, val=None, useweight=False):
-    num_entries = tree.num_entries
-    chunk_size = math.ceil(num_entries/consumers)
+def wait_for_space(queue):
+    while True:
+        depth = channel.queue_declare(queue=queue, durable=True, passive=True).method.message_count
+        metrics.queue_depth.labels(queue).set(depth)
+        if depth < max_queued:
+            return
+        connection.sleep(0.5)
 
-    chunks = 0
-    for chunk in tree_chunks(tree, chunk_size, useweight):
-        chunks += 1
+def encode_units(chunk, entry_start, s, val):
+    # Each work unit is identified by its sample and entry range
+    unit = f"{val}:{entry_start}-{entry_start + len(chunk)}"
+    # One event per line, so consumers can decode a large unit a few lines at a time
+    data = ak.to_json(chunk, line_delimited=True)
+    if len(data) > max_message_bytes and len(chunk) > 1:
+        half = len(chunk) // 2
+        logging.info(f"Splitting {unit} as its message is {len(data)/1024**2:.1f} MB")
+        yield from encode_units(chunk[:half], entry_start, s, val)
+        yield from encode_units(chunk[half:], entry_start + half, s, val)
+    else:
+        yield {"data": data, "identifier": s, "val": val, "unit": unit}, len(chunk)
+
+# Units waiting to be packed into the next task of each task queue, and their size
+pending = defaultdict(list)
+pending_bytes = defaultdict(int)
+
+def queue_unit(destination, unit, num_events):
+    size = len(unit["data"])
+    if pending_bytes[destination] + size > max_message_bytes:
+        flush_units(destination)
+    pending[destination].append((unit, num_events))
+    pending_bytes[destination] += size
+    if pending_bytes[destination] >= pack_bytes:
+        flush_units(destination)
+
+def flush_units(destination):
+    """Publish the pending units of a task queue as one task."""
+    units = pending.pop(destination, [])
+    pending_bytes.pop(destination, None)
+    if not units:
+        return
+    with metrics.timed('encode'):
+        body = json.dumps({"units": [u for u, _ in units], "run_id": run_id, "lumi": lumi, "cuts": cuts})
+    wait_for_space(destination)
+    with metrics.timed('publish'):
         channel.basic_publish(
             exchange='',
             routing_key=destination,
-            body=json.dumps({"data": ak.to_json(chunk), "identifier": s, "val": val}),
+            body=body,
             properties=pika.BasicProperties(
                 delivery_mode=2,  # Make the message persistent
             )
         )
-        logging.info(f" [x] Sent {chunks}")
+    metrics.count(destination, body, sum(n for _, n in units), 'out')
+    sent_time = time.time()
+    for u, _ in units:
+        in_flight.setdefault(u["unit"], sent_time)
+    logging.info(f" [x] Sent a task of {len(units)} units")
+
+@profiling.profiled('producer.send_chunks')
+def send_chunks(tree, destination, s, val=None, useweight=False):
+    chunk_size = entries_per_chunk(tree, useweight)
+
+    chunks = 0
+    for chunk, report in tree_chunks(tree, chunk_size, useweight):
+        with metrics.timed('encode'):
+            units = list(encode_units(chunk, report.tree_entry_start, s, val))
+        for unit, num_events in units:
+            chunks += 1
+            work_units[unit["unit"]] = (destination, s, val, useweight)
+            queue_unit(destination, unit, num_events)
     return chunks
-# Wait for a successful connection
-connection = connect_to_rabbitmq()
-
-# Create a channel
-channel = connection.channel()
-
-# Declare a queue
-channel.queue_declare(queue='task_queue', durable=True)
-channel.queue_declare(queue='chunks_queue', durable=True)
-channel.queue_declare(queue='time_queue', durable=True)
-channel.queue_declare(queue='mc_task_queue', durable=True)
-channel.queue_declare(queue='mc_chunks_queue', durable=True)
-
-overall_chunks = 0
-overall_mc_chunks = 0
-for s in samples:
-    for val in samples[s]['list']:
-        if s == 'data':
-            tree = get_tree(val)
-            chunks = send_chunks(tree, 'task_queue', s)
-            overall_chunks += chunks
-        else:
-            MC_tree = get_MC_tree(val)
-            mc_chunks = send_chunks(MC_tree, 'mc_task_queue', s, val=val, useweight=True)
-            overall_mc_chunks += mc_chunks
-
-
-channel.basic_publish(exchange='',routing_key='chunks_queue',body=json.dumps(overall_chunks))
-channel.basic_publish(exchange='',routing_key='mc_chunks_queue',body=json.dumps(overall_mc_chunks))
-channel.basic_publish(exchange='',routing_key='time_queue',body=json.dumps(start_time))
-# Close the connection
-connection.close()
+
+# Every work unit sent in this run, so the ones a collector lost can be sent again
+work_units = {}
+# Units sent and not yet reported complete by the collector, with the time they were first sent
+in_flight = {}
+durations = [] # seconds from sending to completion of the completed units
+completed_at = {} # unit -> when the collector reported adding it
+speculated = set()
+
+def send_again(unit_ids):
+    """Read the given units of this run again and send them."""
+    trees = {}
+    for unit_id in unit_ids:
+        destination, s, val, useweight = work_units[unit_id]
+        if val not in trees:
+            trees[val] = get_MC_tree(val) if useweight else get_tree(val)
+        entry_start, entry_stop = map(int, unit_id.rpartition(':')[2].split('-'))
+        with metrics.timed('read'):
+            chunk = trees[val].arrays(branches(useweight), library="ak", entry_start=entry_start, entry_stop=entry_stop)
+        queue_unit(destination, {"data": ak.to_json(chunk, line_delimited=True), "identifier": s, "val": val, "unit": unit_id}, len(chunk))
+    flush_units('task_queue')
+    flush_units('mc_task_queue')
+
+def speculate():
+    """Send again the units that have been out far longer than most units take."""
+    connection.call_later(speculate_interval, speculate)
+    if len(durations) < speculate_min_completed or not in_flight:
+        return
+    # Only once nothing is waiting, so the copies go to consumers that are otherwise idle
+    if any(channel.queue_declare(queue=queue, durable=True, passive=True).method.message_count for queue in ['task_queue', 'mc_task_queue']):
+        return
+    deadline = max(speculate_min_seconds, speculate_factor * np.percentile(durations, speculate_percentile))
+    now = time.time()
+    stragglers = [unit_id for unit_id, sent_time in in_flight.items() if now - sent_time > deadline and unit_id not in speculated]
+    if stragglers:
+        logging.info(f"Sending {len(stragglers)} units again as they have been out for over {deadline:.1f} s")
+        speculated.update(stragglers)
+        metrics.speculative.labels(metrics.role).inc(len(stragglers))
+        send_again(stragglers)
+
+def plan_sample(tree, useweight):
+    # Units before any is split for being too large, so the final count can be a little higher
+    return {"events": tree.num_entries, "units": math.ceil(tree.num_entries / entries_per_chunk(tree, useweight))}
+
+def publish_plan(plan):
+    channel.basic_publish(exchange='', routing_key=broker.run_queue('control_queue', run_id),
+                          body=json.dumps({"run_id": run_id, "type": "plan", "samples": plan}))
+    logging.info(f"Planned {sum(p['events'] for p in plan.values())} events in {sum(p['units'] for p in plan.values())} work units")
+
+def publish_counts():
+    control_queue = broker.run_queue('control_queue', run_id)
+    channel.basic_publish(exchange='',routing_key=control_queue,body=json.dumps({"run_id": run_id, "type": "chunks", "chunks": overall_chunks}))
+    channel.basic_publish(exchange='',routing_key=control_queue,body=json.dumps({"run_id": run_id, "type": "mc_chunks", "chunks": overall_mc_chunks}))
+
+# Callback function for requests from the collector about a run this producer sent
+def callback_schedule(ch, method, properties, body):
+    message = json.loads(body)
+    if message["type"] == "completed":
+        now = message["time"] # when the collector added them, notices are only read once all units are sent
+        for unit_id in message["units"]:
+            completed_at[unit_id] = now
+            sent_time = in_flight.pop(unit_id, None)
+            if sent_time is not None:
+                durations.append(now - sent_time)
+    elif message["type"] == "resend":
+        # A restarted collector lost the results it reported adding after its checkpoint, unless it
+        # has added them again since. It acknowledges results only once reported, so the units still
+        # in flight are on their way, and left to the straggler path if they are not.
+        checkpoint_time = message["checkpoint_time"]
+        completed = set(message["completed"])
+        missing = [unit_id for unit_id, added in completed_at.items() if added > checkpoint_time and unit_id not in completed]
+        # Answered before reading the units again, which tells the collector this run is still live
+        publish_counts()
+        send_again(missing)
+        logging.info(f"Sent {len(missing)} missing work units again")
+    elif message["type"] == "retry":
+        # Units that reached the collector in a partial result it could not add
+        send_again(message["units"])
+    elif message["type"] == "done":
+        ch.stop_consuming()
+
+def start_run(config):
+    """Send every work unit of one analysis run, described by a submit request."""
+    global path, run_id, lumi, cuts, connection, channel, overall_chunks, overall_mc_chunks
+    path = config["href"]
+    run_id = config["run_id"]
+    profiling.run_id = run_id
+    lumi = config["lumi"]
+    # The selection travels with every task, so consumers need no change to run new cuts
+    cuts = config.get("cuts") or selection.cuts
+    # Data and Monte Carlo are selected alike, so only the branches read for both can be cut on
+    selection.check(cuts, branches(False), analysis.derived)
+    start_time = config.get("start_time", time.time())
+    selected_samples = config.get("samples") # empty means every sample
+    run_samples = {s: [val for val in samples[s]['list'] if not selected_samples or val in selected_samples] for s in samples}
+    metrics.start('producer')
+
+    # Wait for a successful connection
+    connection = broker.connect_to_rabbitmq()
+
+    # Create a channel
+    channel = connection.channel()
+
+    # Declare a queue
+    channel.queue_declare(queue='task_queue', durable=True)
+    channel.queue_declare(queue='mc_task_queue', durable=True)
+    channel.queue_declare(queue='runs_queue', durable=True)
+    # Declared before any task is sent so no result is dropped if the collector is still starting
+    broker.declare_run_queues(channel, run_id)
+    schedule_queue = broker.run_queue('schedule_queue', run_id)
+    channel.queue_declare(queue=schedule_queue, durable=True)
+
+    # Announce the run to the collector
+    channel.basic_publish(
+        exchange='',
+        routing_key='runs_queue',
+        body=json.dumps({"run_id": run_id, "lumi": lumi, "start_time": start_time, "samples": run_samples, "cuts": list(cuts)}),
+        properties=pika.BasicProperties(delivery_mode=2)
+    )
+    logging.info(f"Started run {run_id}")
+
+    # Every file is opened before the first task so the collector can follow the run's progress from the start
+    trees = {val: get_tree(val) if s == 'data' else get_MC_tree(val) for s in run_samples for val in run_samples[s]}
+    publish_plan({val: plan_sample(trees[val], s != 'data') for s in run_samples for val in run_samples[s]})
+
+    overall_chunks = 0
+    overall_mc_chunks = 0
+    for s in run_samples:
+        for val in run_samples[s]:
+            if s == 'data':
+                chunks = send_chunks(trees[val], 'task_queue', s, val=val)
+                overall_chunks += chunks
+            else:
+                mc_chunks = send_chunks(trees[val], 'mc_task_queue', s, val=val, useweight=True)
+                overall_mc_chunks += mc_chunks
+
+
+    # Send whatever is left over once every sample has been read
+    flush_units('task_queue')
+    flush_units('mc_task_queue')
+
+    publish_counts()
+    remote.log_transfers()
+
+    # Stay until the collector has finished the run, sending again units that are lost or late
+    channel.basic_consume(queue=schedule_queue, on_message_callback=callback_schedule, auto_ack=True)
+    if speculate_factor:
+        connection.call_later(speculate_interval, speculate)
+    channel.start_consuming()
+    channel.queue_delete(queue=schedule_queue)
+    # Close the connection
+    connection.close()
+    # A run forked in service mode exits without running atexit handlers
+    profiling.dump_all()
+
+# Callback function for a run submitted to the warm service
+def callback_submit(ch, method, properties, body):
+    config = json.loads(body)
+    multiprocessing.active_children() # reap runs that have finished
+    try:
+        selection.check(config.get("cuts") or selection.cuts, branches(False), analysis.derived)
+    except ValueError as e:
+        # Answered here, as the run's child would only die and leave submit.py waiting
+        logging.error(f"Rejected run {config['run_id']}: {e}")
+        ch.basic_publish(exchange='', routing_key=broker.run_queue('done_queue', config['run_id']),
+                         body=json.dumps({"run_id": config['run_id'], "error": str(e)}))
+        return
+    # A forked child starts with every module already imported and opens its own connection
+    multiprocessing.Process(target=start_run, args=(config,)).start()
+    logging.info(f"Submitted run {config['run_id']}")
+
+if __name__ == '__main__':
+    if service_mode:
+        connection = broker.connect_to_rabbitmq()
+        channel = connection.channel()
+        channel.queue_declare(queue='submit_queue', durable=True)
+        channel.basic_consume(queue='submit_queue', on_message_callback=callback_submit, auto_ack=True)
+        logging.info("Producer is waiting for runs on 'submit_queue'...")
+        channel.start_consuming()
+    else:
+        start_run({"run_id": os.getenv('RUN_ID') or uuid.uuid4().hex[:8],
+                   "lumi": float(os.getenv('LUMI', 10.0)),
+                   "samples": [name for name in os.getenv('SAMPLES', '').split(',') if name],
+                   "cuts": json.loads(os.getenv('CUTS') or 'null'),
+                   "href": sys.argv[1]})
@@ -0,0 +1,106 @@
+"""Optional profiling of the hot callbacks, switched on with the PROFILE environment variable
+
+PROFILE=cprofile aggregates cProfile statistics into {name}-{host}-{pid}.prof (readable with pstats or snakeviz).
+PROFILE=sample samples the call stack every PROFILE_INTERVAL seconds into {name}-{host}-{pid}.folded, one
+'frame;frame;frame count' line per stack, ready for flamegraph.pl or speedscope.
+A process that sets run_id, such as a run forked by a service mode producer, adds it to the file names.
+Profiles are rewritten every PROFILE_EVERY calls, when the process exits and on dump_all(), which a
+forked process has to call itself as it exits without running atexit handlers.
+"""
+import os
+import sys
+import time
+import atexit
+import socket
+import logging
+import cProfile
+import threading
+import functools
+from collections import Counter
+
+mode = os.getenv('PROFILE', '').lower()
+every = int(os.getenv('PROFILE_EVERY', 10))
+interval = float(os.getenv('PROFILE_INTERVAL', 0.005))
+profile_dir = os.getenv('PROFILE_DIR', '/app/logs/profiles')
+host = socket.gethostname() # the container id inside docker
+run_id = None
+dumps = [] # writes the profile of each profiled function
+
+class Sampler:
+    """Collects the stacks of whichever thread is inside a profiled call."""
+    def __init__(self):
+        self.start()
+        # A forked child has only the forking thread, so it starts a sampler of its own
+        os.register_at_fork(after_in_child=self.start)
+
+    def start(self):
+        self.stacks = Counter()
+        self.thread_id = None
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(interval)
+            thread_id = self.thread_id
+            frame = sys._current_frames().get(thread_id) if thread_id is not None else None
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                with self.lock:
+                    self.stacks[';'.join(reversed(stack))] += 1
+
+    def enable(self):
+        self.thread_id = threading.get_ident()
+
+    def disable(self):
+        self.thread_id = None
+
+    def dump_stats(self, path):
+        with self.lock:
+            lines = [f"{stack} {count}\n" for stack, count in self.stacks.items()]
+        with open(path, 'w') as f:
+            f.writelines(lines)
+
+def dump(profiler, name):
+    os.makedirs(profile_dir, exist_ok=True)
+    extension = 'prof' if mode == 'cprofile' else 'folded'
+    suffix = f"-{run_id}" if run_id else ""
+    path = os.path.join(profile_dir, f"{name}-{host}-{os.getpid()}{suffix}.{extension}")
+    profiler.dump_stats(path)
+    logging.info(f"profile written to {path}")
+
+def profiled(name):
+    """Profile every call of the decorated function under name, e.g. 'consumer.callback'."""
+    def decorator(function):
+        if mode not in ('cprofile', 'sample'):
+            return function
+        profiler = cProfile.Profile() if mode == 'cprofile' else Sampler()
+        calls = 0
+        def write():
+            if calls:
+                dump(profiler, name)
+        dumps.append(write)
+        atexit.register(write)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            nonlocal calls
+            profiler.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.disable()
+                calls += 1
+                if calls % every == 0:
+                    dump(profiler, name)
+        return wrapper
+    return decorator
+
+def dump_all():
+    """Write the profile of every profiled function that has been called."""
+    for write in dumps:
+        write()
@@ -0,0 +1,183 @@
+"""Reading ROOT files over HTTP through one pool of keep-alive connections
+
+uproot's default HTTP source asks for each basket with its own small request. RemoteSource merges
+the byte ranges uproot asks for together into fewer, larger requests (ranges less than
+REMOTE_MAX_GAP_KB apart are read as one, up to REMOTE_MAX_REQUEST_MB), sends them in parallel
+over REMOTE_CONNECTIONS connections shared by every file a process opens, and reads at least
+REMOTE_READAHEAD_KB at a time for the small sequential reads of headers and keys. Bytes moved,
+requests and time are counted per file in transfers.
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import uproot
+
+enabled = os.getenv('REMOTE_READER', 'True').lower() == 'true'
+connections = int(os.getenv('REMOTE_CONNECTIONS', 8))
+max_gap = float(os.getenv('REMOTE_MAX_GAP_KB', 64)) * 1024
+max_request_bytes = float(os.getenv('REMOTE_MAX_REQUEST_MB', 8)) * 1024**2
+readahead_bytes = float(os.getenv('REMOTE_READAHEAD_KB', 256)) * 1024
+readahead_blocks = 8 # blocks kept per file for reads falling inside an earlier read-ahead
+timeout = float(os.getenv('REMOTE_TIMEOUT', 60))
+retries = int(os.getenv('REMOTE_RETRIES', 3))
+
+# Per file: requests sent, bytes uproot asked for, bytes transferred, reads served by read-ahead
+# and seconds spent waiting on responses
+transfers = defaultdict(lambda: {"requests": 0, "requested_bytes": 0, "transferred_bytes": 0, "readahead_hits": 0, "seconds": 0.0})
+transfers_lock = threading.Lock()
+
+_shared = {}
+
+def shared():
+    """The session and threads of this process, made again in a forked child so no socket is shared."""
+    pid = os.getpid()
+    if pid not in _shared:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections,
+                              max_retries=Retry(total=retries, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _shared.clear()
+        _shared[pid] = (session, ThreadPoolExecutor(max_workers=connections, thread_name_prefix='remote'))
+    return _shared[pid]
+
+def count(file_path, **amounts):
+    with transfers_lock:
+        for key, amount in amounts.items():
+            transfers[file_path][key] += amount
+
+def fetch(file_path, start, stop):
+    """Bytes start to stop of a file, in one range request."""
+    session, _ = shared()
+    begin = time.perf_counter()
+    response = session.get(file_path, headers={"Range": f"bytes={start}-{stop - 1}"}, timeout=timeout)
+    response.raise_for_status()
+    data = response.content
+    if response.status_code == 200:
+        # The server ignored the range and sent the whole file
+        data = data[start:stop]
+    count(file_path, requests=1, transferred_bytes=len(response.content), seconds=time.perf_counter() - begin)
+    return data
+
+def coalesce(ranges):
+    """Merge sorted (start, stop) ranges closer than max_gap into requests of at most max_request_bytes."""
+    merged = []
+    for start, stop in sorted(set(ranges)):
+        if merged and start - merged[-1][1] <= max_gap and max(stop, merged[-1][1]) - merged[-1][0] <= max_request_bytes:
+            merged[-1][1] = max(stop, merged[-1][1])
+        else:
+            merged.append([start, stop])
+    return merged
+
+def sliced(parent, offset, length):
+    # A future for part of a merged request, a view so the bytes are not copied
+    future = Future()
+    def done(f):
+        if f.exception() is not None:
+            future.set_exception(f.exception())
+        else:
+            future.set_result(memoryview(f.result())[offset:offset + length])
+    parent.add_done_callback(done)
+    return future
+
+class RemoteSource(uproot.source.chunk.Source):
+    """An uproot source for HTTP(S) files, opened with uproot.open(url, handler=RemoteSource)."""
+
+    def __init__(self, file_path, **options):
+        super().__init__()
+        self._file_path = file_path
+        self._blocks = OrderedDict() # (start, stop) -> data of recent read-ahead requests
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __repr__(self):
+        return f"<RemoteSource {self._file_path!r} at 0x{id(self):012x}>"
+
+    @property
+    def num_bytes(self):
+        if self._num_bytes is None:
+            session, _ = shared()
+            response = session.head(self._file_path, timeout=timeout, allow_redirects=True)
+            response.raise_for_status()
+            self._num_bytes = int(response.headers["Content-Length"])
+        return self._num_bytes
+
+    def cached(self, start, stop):
+        with self._lock:
+            for (block_start, block_stop), data in self._blocks.items():
+                if block_start <= start and stop <= block_stop:
+                    return memoryview(data)[start - block_start:stop - block_start]
+        return None
+
+    def chunk(self, start, stop):
+        self._num_requests += 1
+        self._num_requested_chunks += 1
+        self._num_requested_bytes += stop - start
+        count(self._file_path, requested_bytes=stop - start)
+
+        data = self.cached(start, stop)
+        if data is not None:
+            count(self._file_path, readahead_hits=1)
+            return uproot.source.chunk.Chunk.wrap(self, data, start)
+        # Small reads are mostly followed by reads just after them, so read ahead
+        block_stop = max(stop, start + int(readahead_bytes))
+        if self._num_bytes is not None:
+            block_stop = max(stop, min(block_stop, self._num_bytes))
+        data = fetch(self._file_path, start, block_stop)
+        with self._lock:
+            self._blocks[(start, start + len(data))] = data
+            while len(self._blocks) > readahead_blocks:
+                self._blocks.popitem(last=False)
+        return uproot.source.chunk.Chunk.wrap(self, memoryview(data)[:stop - start], start)
+
+    def chunks(self, ranges, notifications):
+        self._num_requests += 1
+        self._num_requested_chunks += len(ranges)
+        self._num_requested_bytes += sum(stop - start for start, stop in ranges)
+        count(self._file_path, requested_bytes=sum(stop - start for start, stop in ranges))
+
+        _, executor = shared()
+        merged = coalesce(ranges)
+        futures = [executor.submit(fetch, self._file_path, start, stop) for start, stop in merged]
+        request_starts = [start for start, _ in merged]
+        chunks = []
+        for start, stop in ranges:
+            # The merged requests are sorted and disjoint, so the last one starting before this range holds it
+            i = bisect.bisect_right(request_starts, start) - 1
+            request_start, future = merged[i][0], futures[i]
+            chunk = uproot.source.chunk.Chunk(self, start, stop, sliced(future, start - request_start, stop - start))
+            chunk.future.add_done_callback(uproot.source.chunk.notifier(chunk, notifications))
+            chunks.append(chunk)
+        return chunks
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        # The connections and threads stay up for the next file
+        self._closed = True
+        self._blocks.clear()
+
+def open_file(file_path, **options):
+    """uproot.open, through RemoteSource for http(s) paths unless REMOTE_READER is false."""
+    if enabled and file_path.startswith(('http://', 'https://')):
+        options.setdefault('handler', RemoteSource)
+    return uproot.open(file_path, **options)
+
+def log_transfers():
+    with transfers_lock:
+        for file_path, stats in transfers.items():
+            rate = stats["transferred_bytes"] / 1024**2 / stats["seconds"] if stats["seconds"] else 0
+            logging.info(f"{file_path}: {stats['requests']} requests, {stats['transferred_bytes']/1024**2:.1f} MB transferred "
+                         f"for {stats['requested_bytes']/1024**2:.1f} MB read, {stats['readahead_hits']} read-ahead hits, {rate:.1f} MB/s")
@@ -0,0 +1,198 @@
+"""Feed messages recorded with CAPTURE_DIR to a consumer or the collector, without a broker
+
+The callbacks of consumer.py or collector.py are run in this process on a local stand-in for the
+pika connection, as fast as they go or at the pace the messages were recorded, and the messages per
+second and the time each callback took are reported next to the times recorded in the live run,
+so a change to those hot paths can be measured on the same messages before and after, e.g.
+    python replay.py output/captures/consumer-*.jsonl --role consumer
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+import numpy as np
+
+parser = argparse.ArgumentParser(description="Replay recorded task or result messages into a consumer or the collector")
+parser.add_argument('captures', nargs='+', help="capture files written with CAPTURE_DIR, or that folder")
+parser.add_argument('--role', choices=['consumer', 'collector'], required=True, help="whose callbacks receive the messages")
+parser.add_argument('--pace', choices=['max', 'recorded'], default='max',
+                    help="deliver each message as soon as the last is handled, or at its recorded time after the first")
+parser.add_argument('--repeat', type=int, default=1, help="times to deliver the messages, for a consumer")
+args = parser.parse_args()
+
+class LocalChannel:
+    """The parts of a pika channel the consumer and collector use, with queues held in memory."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.consumers = {} # queue -> callback
+        self.tags = {} # consumer tag -> queue
+        self.published = defaultdict(lambda: [0, 0]) # queue -> messages, bytes
+        self.delivery_tags = itertools.count(1)
+
+    def basic_qos(self, **kwargs):
+        pass
+
+    def queue_declare(self, queue, **kwargs):
+        # Nothing is ever left waiting in a local queue
+        return SimpleNamespace(method=SimpleNamespace(queue=queue, message_count=0))
+
+    def queue_delete(self, queue):
+        pass
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        tag = f"ctag{len(self.tags) + 1}"
+        self.consumers[queue] = on_message_callback
+        self.tags[tag] = queue
+        return tag
+
+    def basic_cancel(self, tag):
+        self.consumers.pop(self.tags.pop(tag, None), None)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published[routing_key][0] += 1
+        self.published[routing_key][1] += len(body)
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        pass
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        pass
+
+    def stop_consuming(self):
+        pass
+
+    def close(self):
+        pass
+
+    def deliver(self, queue, body):
+        """Run the callback of queue on one message, False if nothing consumes from queue."""
+        callback = self.consumers.get(queue)
+        if callback is None:
+            return False
+        method = SimpleNamespace(delivery_tag=next(self.delivery_tags), routing_key=queue, redelivered=False)
+        callback(self, method, SimpleNamespace(), body)
+        return True
+
+class LocalConnection:
+    """The timers of a pika BlockingConnection, run between messages."""
+
+    def __init__(self):
+        self.timers = []
+        self.sequence = itertools.count()
+
+    def channel(self):
+        return LocalChannel(self)
+
+    def call_later(self, delay, callback):
+        timer = [time.perf_counter() + delay, next(self.sequence), callback]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def remove_timeout(self, timer):
+        timer[2] = None
+
+    def process_timers(self, until=None):
+        # until=None runs every timer set so far, as happens when the connection goes idle at the end
+        due = [timer for timer in self.timers if until is None or timer[0] <= until]
+        self.timers = [timer for timer in self.timers if timer not in due]
+        heapq.heapify(self.timers)
+        for _, _, callback in sorted(due):
+            if callback is not None:
+                callback()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def close(self):
+        pass
+
+def read_captures(paths, role):
+    messages = []
+    for path in paths:
+        # From a folder, only the captures of the role being replayed
+        files = ([os.path.join(path, name) for name in sorted(os.listdir(path)) if name.startswith(role + '-') and name.endswith('.jsonl')]
+                 if os.path.isdir(path) else [path])
+        for name in files:
+            with open(name) as f:
+                messages += [json.loads(line) for line in f if line.strip()]
+    return sorted(messages, key=lambda message: message["time"])
+
+def percentiles(seconds):
+    if not seconds:
+        return "-"
+    return " ".join(f"{np.percentile(seconds, q) * 1000:>9.2f}" for q in (50, 90, 99)) + f" {max(seconds) * 1000:>9.2f}"
+
+if __name__ == '__main__':
+    messages = read_captures(args.captures, args.role)
+    if not messages:
+        raise SystemExit("no messages in the capture files")
+    output = tempfile.mkdtemp(prefix='replay-')
+    # Plots, artifacts and checkpoints of a replayed collector go to a scratch folder
+    os.environ.setdefault('OUTPUT_DIR', output)
+    os.environ.setdefault('CHECKPOINT_DIR', os.path.join(output, 'checkpoints'))
+    os.environ['METRICS_PORT'] = '0'
+    if args.role == 'consumer':
+        import consumer as role
+    else:
+        import collector as role
+        role.service_mode = True # a finished run must not shut the broker and consumers down
+    connection = LocalConnection()
+    channel = connection.channel()
+    role.connection = connection
+    role.channel = channel
+    if args.role == 'consumer':
+        for queue, callback in [('task_queue', role.callback), ('mc_task_queue', role.mc_callback)]:
+            channel.basic_consume(queue=queue, on_message_callback=callback)
+    else:
+        channel.basic_consume(queue='runs_queue', on_message_callback=role.callback_run, auto_ack=True)
+
+    replayed = defaultdict(list) # queue -> seconds each callback took
+    recorded = defaultdict(list)
+    late = [] # seconds behind the recorded pace when delivered
+    dropped = 0
+    start_time = time.perf_counter()
+    for _ in range(args.repeat):
+        first = messages[0]["time"]
+        pass_start = time.perf_counter()
+        for message in messages:
+            if args.pace == 'recorded':
+                scheduled = pass_start + message["time"] - first
+                while time.perf_counter() < scheduled:
+                    connection.process_timers(time.perf_counter())
+                    time.sleep(min(0.001, max(scheduled - time.perf_counter(), 0)))
+                late.append(time.perf_counter() - scheduled)
+            # Per run queues are reported together
+            queue = message["queue"].split('.')[0]
+            callback_start = time.perf_counter()
+            if not channel.deliver(message["queue"], message["body"]):
+                dropped += 1
+                continue
+            replayed[queue].append(time.perf_counter() - callback_start)
+            recorded[queue].append(message["seconds"])
+            connection.process_timers(time.perf_counter())
+    connection.process_timers()
+    elapsed = time.perf_counter() - start_time
+
+    delivered = sum(len(seconds) for seconds in replayed.values())
+    print(f"{delivered} messages replayed into the {args.role} in {elapsed:.2f} s, {delivered / elapsed:.1f} messages/s"
+          + (f", {dropped} dropped as nothing consumed their queue" if dropped else ""))
+    print(f"{'callback ms':<18}{'messages':>9}  {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    for queue in replayed:
+        print(f"{queue:<18}{len(replayed[queue]):>9}  {percentiles(replayed[queue])}  replayed")
+        print(f"{'':<18}{len(recorded[queue]):>9}  {percentiles(recorded[queue])}  recorded")
+    if late:
+        print(f"{'behind pace ms':<18}{len(late):>9}  {percentiles(late)}")
+    published = defaultdict(lambda: [0, 0])
+    for queue, (count, size) in channel.published.items():
+        published[queue.split('.')[0]][0] += count
+        published[queue.split('.')[0]][1] += size
+    for queue, (count, size) in sorted(published.items()):
+        print(f"published {count} messages, {size / 1024**2:.2f} MB to {queue}")
+    logging.info(f"Output written to {output}")
@@ -0,0 +1,36 @@
+"""Draw the plot of a finished run again from the histograms saved next to it
+
+    python replot.py "output/19-10-2026 14-02 1a2b3c4d.npz" --xmin 100 --xmax 160 --step 2 --output zoom.pdf
+"""
+import argparse
+import os
+import time
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import plotting
+
+parser = argparse.ArgumentParser(description="Plot the histograms of a run saved by the collector or the dask executor")
+parser.add_argument('artifact', help="the .npz file saved with the plot")
+parser.add_argument('--output', help="image to write, the artifact's name with .png if not given; the extension sets the format")
+parser.add_argument('--xmin', type=float, help="lower edge of the plot in GeV, as in the run if not given")
+parser.add_argument('--xmax', type=float, help="upper edge of the plot in GeV")
+parser.add_argument('--step', type=float, help="bin width in GeV, a multiple of the 0.5 GeV base bins")
+parser.add_argument('--no-syst', action='store_true', help="leave out the systematic uncertainty band")
+parser.add_argument('--logy', action='store_true', help="logarithmic y axis")
+parser.add_argument('--dpi', type=float, default=100)
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    start_time = time.perf_counter()
+    info, hists, variations = plotting.load_artifact(args.artifact)
+    xmin, xmax, step = info["binning"]
+    binning = (args.xmin if args.xmin is not None else xmin, args.xmax if args.xmax is not None else xmax, args.step or step)
+    axes = plotting.plot_samples(hists, info["groups"], {} if args.no_syst else variations, info["styles"], info["lumi"], binning)
+    if args.logy:
+        axes.set_yscale('log')
+        axes.set_ylim(bottom=0.1)
+    output = args.output or os.path.splitext(args.artifact)[0] + '.png'
+    plt.savefig(output, dpi=args.dpi)
+    plt.close()
+    print(f"Run {info.get('run_id')}: plot saved as {output} in {time.perf_counter() - start_time:.2f} s")
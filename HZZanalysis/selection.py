@@ -0,0 +1,120 @@
+"""Event selections written as expressions over branches and compiled into one numexpr kernel
+
+A cut is a named expression that is true for the events to keep, where branch[i] is the i-th
+entry of a per-lepton branch, e.g. 'lep_charge[0] + lep_charge[1] + lep_charge[2] + lep_charge[3] == 0'.
+All cuts of a selection are fused into a single kernel, so their sums and comparisons are evaluated
+in one blocked pass without intermediate arrays. Selections travel with the run configuration, so
+changing a cut needs no change to the consumers.
+
+For the cutflow the same kernel sets bit i of an integer for the events passing cut i instead, and
+one bincount of those integers gives the events and sum of weights left after each cut in turn.
+"""
+import re
+import csv
+import numpy as np
+import awkward as ak
+import numexpr
+from numexpr.necompiler import getType, getExprNames
+
+cuts = {
+    # electron type is 11, muon type is 13, so keep eeee (44), eemm (48) and mmmm (52)
+    'lep_type' : '(lep_type[0] + lep_type[1] + lep_type[2] + lep_type[3] == 44)'
+                 ' | (lep_type[0] + lep_type[1] + lep_type[2] + lep_type[3] == 48)'
+                 ' | (lep_type[0] + lep_type[1] + lep_type[2] + lep_type[3] == 52)',
+    # the four lepton charges have to add up to zero
+    'lep_charge' : 'lep_charge[0] + lep_charge[1] + lep_charge[2] + lep_charge[3] == 0',
+}
+
+element = re.compile(r'\b([A-Za-z_]\w*)\[(\d+)\]')
+
+# Every event of the 4lep samples has at least four leptons, so branch[0] to branch[3] can always be read
+num_leptons = 4
+# The cutflow counts 2**cuts bit patterns, and numexpr integers have 32 bits
+max_cuts = 16
+
+def translate(expression):
+    # numexpr has no indexing, so lep_type[0] becomes the variable lep_type__0
+    return element.sub(r'\1__\2', expression)
+
+def fused(selection):
+    return ' & '.join(f"({translate(expression)})" for expression in selection.values())
+
+def flagged(selection):
+    return ' + '.join(f"where({translate(expression)}, {1 << i}, 0)" for i, expression in enumerate(selection.values()))
+
+def check(selection, lists, scalars):
+    """Raise ValueError, before any task is sent, for a selection the consumers could not evaluate:
+    one numexpr cannot parse, reading no branch (a constant such as '1 == 1' gives no per-event
+    mask), reading anything but the per-lepton branches in lists (by index, up to num_leptons) and
+    the per-event columns in scalars, or with more than max_cuts cuts."""
+    if len(selection) > max_cuts:
+        raise ValueError(f"a selection can have at most {max_cuts} cuts, not {len(selection)}")
+    for name, expression in selection.items():
+        try:
+            names, _ = getExprNames(translate(expression), {})
+        except Exception as e:
+            raise ValueError(f"cut {name} '{expression}' is not a valid expression: {e}")
+        if not names:
+            raise ValueError(f"cut {name} '{expression}' reads no branch, so it is the same for every event")
+        for variable in names:
+            branch, _, index = variable.rpartition('__')
+            if branch and index.isdigit():
+                if branch not in lists:
+                    raise ValueError(f"cut {name} reads {branch}[{index}], but {branch} is not one of the lepton branches {lists}")
+                if int(index) >= num_leptons:
+                    raise ValueError(f"cut {name} reads {branch}[{index}], but only the first {num_leptons} leptons are in every event")
+            elif variable not in scalars:
+                raise ValueError(f"cut {name} reads {variable}, which is not one of {scalars}"
+                                 + (f", lepton branches need an index such as {variable}[0]" if variable in lists else ""))
+
+def column(data, name):
+    branch, _, index = name.rpartition('__')
+    if branch and index.isdigit():
+        return ak.to_numpy(data[branch][:, int(index)])
+    return ak.to_numpy(data[name])
+
+# Compiled kernels, keyed by expression and input types so each selection is compiled once per process
+kernels = {}
+
+def evaluate(expression, data):
+    names, _ = getExprNames(expression, {})
+    inputs = [column(data, name) for name in names]
+    signature = tuple((name, getType(values)) for name, values in zip(names, inputs))
+    key = (expression, signature)
+    if key not in kernels:
+        kernels[key] = numexpr.NumExpr(expression, signature=list(signature))
+    return kernels[key](*inputs)
+
+def empty_cutflow(selection=None):
+    # Rows for all events and after each cut in turn, columns events and sum of weights
+    return np.zeros((len(selection or cuts) + 1, 2))
+
+def mask(data, selection=None, cutflow=None, weights=None):
+    """Boolean array of the events passing every cut of the selection.
+
+    With a cutflow from empty_cutflow, the events and sum of weights (unit weights if none are given)
+    passing no cut, the first cut, the first two and so on are added to it from the same evaluation.
+    """
+    selection = selection or cuts
+    if cutflow is None:
+        return evaluate(fused(selection), data)
+    flags = evaluate(flagged(selection), data)
+    size = 1 << len(selection)
+    events = np.bincount(flags, minlength=size)
+    sumw = events if weights is None else np.bincount(flags, np.asarray(weights, dtype=float), size)
+    patterns = np.arange(size)
+    for i in range(len(selection) + 1):
+        passed = (patterns & ((1 << i) - 1)) == (1 << i) - 1
+        cutflow[i] += [events[passed].sum(), sumw[passed].sum()]
+    return flags == size - 1
+
+def write_cutflow(path, names, cutflows):
+    """Write the cutflow of every sample as CSV, with the fraction of events each cut keeps."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["sample", "cut", "events", "sumw", "kept"])
+        for val, rows in cutflows.items():
+            previous = rows[0][0]
+            for name, (events, sumw) in zip(['all'] + list(names), rows):
+                writer.writerow([val, name, int(events), f"{sumw:.6g}", f"{events / previous:.4f}" if previous else ""])
+                previous = events
@@ -0,0 +1,73 @@
+import pika
+import argparse
+import logging
+import json
+import time
+import uuid
+import sys
+import os
+import analysis
+import broker
+import selection
+
+parser = argparse.ArgumentParser(description="Submit an analysis run to the warm service and wait for its plot")
+parser.add_argument('--href', default=os.getenv('HREF'), help="where the Data/ and MC/ folders are, defaults to HREF")
+parser.add_argument('--lumi', type=float, default=10.0)
+parser.add_argument('--samples', default='', help="comma separated sample names, every sample if not given")
+parser.add_argument('--cuts', type=json.loads, default=None,
+                    help="selection as JSON, e.g. '{\"lep_charge\": \"lep_charge[0] + lep_charge[1] + lep_charge[2] + lep_charge[3] == 0\"}', the default cuts if not given")
+parser.add_argument('--run-id', default=None)
+parser.add_argument('--timeout', type=float, default=3600, help="seconds to wait for the plot")
+parser.add_argument('--no-wait', action='store_true', help="return as soon as the run is queued")
+args = parser.parse_args()
+if args.cuts:
+    # Checked here as well as by the producer, so a bad selection is reported before anything is queued
+    try:
+        selection.check(args.cuts, analysis.variables, analysis.derived)
+    except ValueError as e:
+        parser.error(str(e))
+
+logging.basicConfig(level=logging.WARNING, handlers=[logging.StreamHandler()])
+
+run_id = args.run_id or uuid.uuid4().hex[:8]
+connection = broker.connect_to_rabbitmq()
+channel = connection.channel()
+channel.queue_declare(queue='submit_queue', durable=True)
+done_queue = broker.run_queue('done_queue', run_id)
+if not args.no_wait:
+    # Declared before submitting so the collector's reply cannot be missed
+    channel.queue_declare(queue=done_queue, durable=True)
+
+channel.basic_publish(
+    exchange='',
+    routing_key='submit_queue',
+    body=json.dumps({"run_id": run_id, "lumi": args.lumi, "href": args.href, "start_time": time.time(),
+                     "samples": [name for name in args.samples.split(',') if name], "cuts": args.cuts}),
+    properties=pika.BasicProperties(delivery_mode=2)
+)
+print(f"Submitted run {run_id}")
+if args.no_wait:
+    connection.close()
+    sys.exit(0)
+
+deadline = time.time() + args.timeout
+while True:
+    method, properties, body = channel.basic_get(queue=done_queue, auto_ack=True)
+    if method is not None:
+        result = json.loads(body)
+        if "error" in result:
+            print(f"Run {run_id} failed: {result['error']}")
+            channel.queue_delete(queue=done_queue)
+            connection.close()
+            sys.exit(1)
+        print(f"Run {run_id} finished in {result['elapsed']:.1f} s, plot saved as output/{result['plot']}")
+        break
+    if time.time() > deadline:
+        print(f"Run {run_id} did not finish within {args.timeout} s")
+        channel.queue_delete(queue=done_queue)
+        connection.close()
+        sys.exit(1)
+    connection.sleep(0.2)
+
+channel.queue_delete(queue=done_queue)
+connection.close()
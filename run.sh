@@ -28,6 +28,13 @@ echo "Docker is running. Proceeding with the script..."
 NUM_CONSUMERS=12
 HREF=$(cat datahref.txt)
 DEBUG=false
+LUMI=10.0
+SAMPLES=
+AUTOSCALE=false
+MIN_CONSUMERS=1
+PROFILE=
+SERVICE_MODE=false
+EXECUTOR=broker
 
 # Using keyword arguments for internal variables
 while [[ "$#" -gt 0 ]]; do
@@ -35,15 +42,46 @@ while [[ "$#" -gt 0 ]]; do
         --consumers) NUM_CONSUMERS="$2"; shift ;;
         --href) HREF="$2"; shift ;;
         --debug) DEBUG="$2"; shift ;;
+        --lumi) LUMI="$2"; shift ;;
+        --samples) SAMPLES="$2"; shift ;;
+        --autoscale) AUTOSCALE="$2"; shift ;;
+        --min-consumers) MIN_CONSUMERS="$2"; shift ;;
+        --profile) PROFILE="$2"; shift ;;
+        --service) SERVICE_MODE="$2"; shift ;;
+        --executor) EXECUTOR="$2"; shift ;;
         *) echo "Unknown parameter: $1"; exit 1 ;;
     esac
     shift
 done
 
+# With autoscaling --consumers is the upper bound and the pool starts from --min-consumers
+if [[ "${AUTOSCALE,,}" == "true" ]]; then
+    CONSUMER_REPLICAS=$MIN_CONSUMERS
+    export COMPOSE_PROFILES=autoscale
+else
+    CONSUMER_REPLICAS=$NUM_CONSUMERS
+fi
+
 export NUM_CONSUMERS
+export CONSUMER_REPLICAS
+export MIN_CONSUMERS
 export HREF
 export DEBUG
+export LUMI
+export SAMPLES
+export PROFILE
+export SERVICE_MODE
 
 envsubst < ./HZZanalysis/docker-compose.template.yml > ./HZZanalysis/docker-compose.yml
 
-docker-compose -f "./HZZanalysis/docker-compose.yml" up --build
+if [[ "${EXECUTOR,,}" == "dask" ]]; then
+    # Same analysis on a local dask cluster of NUM_CONSUMERS processes, without the broker
+    docker-compose -f "./HZZanalysis/docker-compose.yml" build producer
+    docker-compose -f "./HZZanalysis/docker-compose.yml" run --rm --no-deps producer python dask_executor.py "$HREF"
+elif [[ "${SERVICE_MODE,,}" == "true" ]]; then
+    # Keep the broker, consumers, collector and producer running and submit runs with ./submit.sh
+    docker-compose -f "./HZZanalysis/docker-compose.yml" up --build -d
+    echo "Services are up, submit runs with ./submit.sh and stop them with docker-compose -f ./HZZanalysis/docker-compose.yml down"
+else
+    docker-compose -f "./HZZanalysis/docker-compose.yml" up --build
+fi
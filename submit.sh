@@ -0,0 +1,5 @@
+#!/bin/bash
+
+# Submit an analysis run to the services started with ./run.sh --service True and wait for its plot
+# e.g. ./submit.sh --lumi 5 --samples data_A,Zee,llll,ggH125_ZZ4lep
+docker-compose -f "./HZZanalysis/docker-compose.yml" exec -T producer python submit.py "$@"